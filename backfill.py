@@ -0,0 +1,419 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from beacon import BeaconClient, split_node_urls
+import metrics
+from clickhouse import (
+    BackgroundInserter,
+    convert_to_columns,
+    convert_to_feature_columns,
+)
+from guess_requester import (
+    DEFAULT_MODEL_FOLDER,
+    DEFAULT_NODE_URL,
+    EndSlotUnkown,
+    buildSlotGuesses,
+    buildSlotGuessesFromFeatures,
+    can_classify_features,
+    downloadSlotBlockRewards,
+    extract_slot_features,
+    split_slot_range,
+)
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 8
+# A chunk holding up the inserts is downloaded again by an idle node once it
+# has taken this many times longer than the average chunk
+HEDGE_FACTOR = 3
+
+
+class ChunkScheduler:
+    """
+    Hands the chunks of a range out to the download workers of several
+    nodes. Chunks are dealt round-robin into one deque per node; a worker
+    whose deque is empty steals the lowest chunk queued on another node, so
+    a slow node ends up with fewer chunks. Only chunks within `window` of the
+    next chunk to be consumed are handed out, which bounds the results
+    waiting to be consumed in order. When nothing is left to steal, an idle
+    worker downloads again the chunk everything else is waiting for if it
+    is much slower than usual; the first copy to arrive is kept. A chunk is
+    never handed again to a node that failed it, and only fails once every
+    node did.
+    """
+
+    def __init__(self, chunks, node_count, window):
+        self.chunks = chunks
+        self.node_count = node_count
+        self.window = window
+        self.queues = [deque() for _ in range(node_count)]
+        for index in range(len(chunks)):
+            self.queues[index % node_count].append(index)
+        self.next_index = 0
+        self.results = {}
+        # Nodes that failed each chunk
+        self.failed_nodes = [set() for _ in chunks]
+        self.started = {}
+        self.hedged = set()
+        self.average_duration = None
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def _first_for(self, queue, node, limit):
+        # Position of the first chunk of the queue this node may take, if any
+        for position, index in enumerate(queue):
+            if index >= limit:
+                return None
+            if node not in self.failed_nodes[index]:
+                return position
+        return None
+
+    def _next_for(self, node, now):
+        limit = self.next_index + self.window
+        own = self.queues[node]
+        position = self._first_for(own, node, limit)
+        if position is not None:
+            index = own[position]
+            del own[position]
+            return index
+        queued = []
+        for queue in self.queues:
+            position = self._first_for(queue, node, limit)
+            if position is not None:
+                queued.append((queue[position], queue, position))
+        if queued:
+            index, queue, position = min(queued, key=lambda item: item[0])
+            del queue[position]
+            return index
+        index = self.next_index
+        if (
+            index in self.started
+            and index not in self.results
+            and index not in self.hedged
+            and self.started[index][0] != node
+            and node not in self.failed_nodes[index]
+            and self.average_duration is not None
+            and now - self.started[index][1] > HEDGE_FACTOR * self.average_duration
+        ):
+            self.hedged.add(index)
+            logging.info(
+                f"Slots {self.chunks[index][0]} to {self.chunks[index][1]} are slow to download, also requesting them from another node"
+            )
+            return index
+        return None
+
+    def take(self, node):
+        # Block until there is a chunk for this node, None once stopped
+        with self.condition:
+            while not self.stopped:
+                now = time.monotonic()
+                index = self._next_for(node, now)
+                if index is not None:
+                    self.started[index] = (node, now)
+                    return index
+                # Wake up now and then to check for a chunk worth hedging
+                self.condition.wait(timeout=1)
+            return None
+
+    def complete(self, index, result, duration):
+        with self.condition:
+            if index in self.results or index < self.next_index:
+                return
+            self.results[index] = (result, None)
+            metrics.QUEUE_DEPTH.labels("download").set(len(self.results))
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration += 0.2 * (duration - self.average_duration)
+            self.condition.notify_all()
+
+    def fail(self, index, node, error):
+        with self.condition:
+            if index in self.results or index < self.next_index:
+                return
+            failed_nodes = self.failed_nodes[index]
+            failed_nodes.add(node)
+            if len(failed_nodes) >= self.node_count:
+                # Every node had a go at it
+                self.results[index] = (None, error)
+            else:
+                # Queued first for the next node that hasn't failed it, and only
+                # nodes that haven't failed it may take it
+                next_node = next(
+                    (node + offset) % self.node_count
+                    for offset in range(1, self.node_count)
+                    if (node + offset) % self.node_count not in failed_nodes
+                )
+                self.queues[next_node].appendleft(index)
+            self.condition.notify_all()
+
+    def result(self, index):
+        # Results are consumed in order, each one moving the window forward
+        with self.condition:
+            while index not in self.results:
+                self.condition.wait()
+            result, error = self.results.pop(index)
+            metrics.QUEUE_DEPTH.labels("download").set(len(self.results))
+            self.next_index = index + 1
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+        return result
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class BackfillPipeline:
+    """
+    Download, classify and insert a slot range as three overlapping stages:
+    sub-ranges are downloaded concurrently from every node in `node_url`
+    (comma-separated), classified in order as they arrive and inserted by a
+    BackgroundInserter. The download window and the insert queue are bounded
+    by `queue_size` (per node for the downloads), so memory stays flat
+    however long the range is. Guesses are stored under `model_version`,
+    and with `store_features` the feature vectors of the blocks are stored
+    too, so that other models can classify them without downloading them
+    again. Chunks already in `feature_store` are classified from it instead
+    of being downloaded, and the finalized slots of the downloaded ones are
+    added to it. With a
+    `model_updater`, each chunk is classified with its latest model.
+    """
+
+    def __init__(
+        self,
+        classifier,
+        db,
+        node_url=DEFAULT_NODE_URL,
+        model_folder=DEFAULT_MODEL_FOLDER,
+        add_to_model=False,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        download_workers=DEFAULT_DOWNLOAD_WORKERS,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        beacon_client=None,
+        model_version="",
+        store_features=True,
+        feature_store=None,
+        model_updater=None,
+    ):
+        self.classifier = classifier
+        self.db = db
+        self.node_url = node_url
+        self.model_folder = model_folder
+        self.add_to_model = add_to_model
+        self.chunk_size = chunk_size
+        self.download_workers = download_workers
+        self.queue_size = queue_size
+        self.model_version = model_version
+        self.store_features = store_features
+        self.feature_store = feature_store
+        self.model_updater = model_updater
+        self.feature_names = None
+        # Slots after it may still be reorged, so they aren't added to the
+        # append-only feature store, looked up at the start of every run
+        self.store_up_to_slot = None
+        if feature_store is not None:
+            self.feature_names = feature_store.feature_names
+        # Adding blocks to the model needs their rewards, not only their features
+        self.read_store = (
+            feature_store is not None
+            and not add_to_model
+            and can_classify_features(classifier)
+        )
+        self.insert_db = None
+        # Chunks left out by the last run, see run
+        self.skipped_ranges = []
+
+        # Routed to the fastest node, for everything but the sharded downloads
+        if beacon_client is None:
+            beacon_client = BeaconClient(node_url)
+        self.beacon_client = beacon_client
+        self.node_clients = [
+            BeaconClient(url, pool_size=download_workers)
+            for url in split_node_urls(node_url)
+        ]
+
+    def update_model(self):
+        # Switch to a retrained model between chunks, its guesses are stored
+        # under its own version and become the ones served
+        if self.model_updater is None:
+            return
+        classifier = self.model_updater.classifier
+        if classifier is self.classifier:
+            return
+        self.classifier = classifier
+        self.model_version = classifier.fingerprint
+        self.read_store = (
+            self.feature_store is not None
+            and not self.add_to_model
+            and can_classify_features(classifier)
+        )
+        self.db.set_active_model_version(self.model_version)
+        logging.info(f"Indexing with model {self.model_version}")
+
+    def _finalized_slot(self):
+        try:
+            return self.beacon_client.header_slot("finalized")
+        except Exception as e:
+            # Stored slots can still be classified
+            logging.error(
+                f"Error getting finalized slot, nothing is added to the feature store: {e}"
+            )
+            return -1
+
+    def _extract_features(self, block_rewards):
+        if self.feature_names is None:
+            from blockprint.classifier import VIABLE_FEATURES
+
+            # Everything a retrained model may use, not only this model's features
+            self.feature_names = sorted(
+                set(VIABLE_FEATURES) | set(self.classifier.features)
+            )
+        return extract_slot_features(block_rewards, self.feature_names)
+
+    def _fetch_chunk(self, chunk_start, chunk_end, node_client):
+        # (block_rewards, slot_features), block_rewards is None when read from the store
+        if self.read_store and self.feature_store.has_range(chunk_start, chunk_end):
+            return None, self.feature_store.get_slot_features(
+                chunk_start, chunk_end, self.classifier.features
+            )
+        block_rewards = downloadSlotBlockRewards(
+            chunk_start, chunk_end, self.node_url, node_client
+        )
+        if self.feature_store is None or block_rewards is None:
+            return block_rewards, None
+        return block_rewards, self._extract_features(block_rewards)
+
+    def _store_chunk(self, chunk_start, chunk_end, slot_features):
+        # Called in slot order, which keeps the index of the store cheap to update
+        store_end_slot = min(chunk_end, self.store_up_to_slot)
+        if store_end_slot >= chunk_start:
+            self.feature_store.append_range(
+                chunk_start,
+                store_end_slot,
+                [row for row in slot_features if row[0] <= store_end_slot],
+            )
+
+    def _feature_columns(self, block_rewards, slot_features):
+        if not self.store_features:
+            return None
+        if slot_features is None:
+            slot_features = self._extract_features(block_rewards)
+        return convert_to_feature_columns(slot_features)
+
+    def _skip(self, chunk_start, chunk_end, reason):
+        # Left missing from the table, where the gap repair finds them
+        logging.error(f"Skipping slots {chunk_start} to {chunk_end}: {reason}")
+        metrics.SLOTS.labels("skipped").inc(chunk_end - chunk_start + 1)
+        self.skipped_ranges.append((chunk_start, chunk_end))
+
+    def _download_worker(self, scheduler, node):
+        node_client = self.node_clients[node]
+        while True:
+            index = scheduler.take(node)
+            if index is None:
+                return
+            chunk_start, chunk_end = scheduler.chunks[index]
+            start = time.monotonic()
+            try:
+                result = self._fetch_chunk(chunk_start, chunk_end, node_client)
+            except Exception as e:
+                # Another node may be synced further, or be healthy
+                scheduler.fail(index, node, e)
+                continue
+            scheduler.complete(index, result, time.monotonic() - start)
+
+    def run(self, start_slot, end_slot):
+        """
+        Index slots start_slot..end_slot (inclusive). Chunks are inserted in
+        slot order, and the returned value is the last slot of the processed
+        prefix (start_slot - 1 if none was). A chunk the nodes refuse to
+        serve, or with a block the classifier can't guess, is skipped rather
+        than ending the prefix: it is logged, counted and listed in
+        `skipped_ranges`, and its slots are left missing from the table, where
+        the gap scan of repair_gaps finds them. The slots up to the returned
+        one are therefore only all inserted if `skipped_ranges` is empty.
+        Stops early without raising when no node knows the end slot of a
+        chunk yet.
+        """
+        chunks = split_slot_range(start_slot, end_slot, self.chunk_size)
+        node_count = len(self.node_clients)
+        scheduler = ChunkScheduler(chunks, node_count, self.queue_size * node_count)
+        if self.insert_db is None:
+            self.insert_db = self.db.clone()
+        if self.feature_store is not None:
+            self.store_up_to_slot = self._finalized_slot()
+        inserter = BackgroundInserter(self.insert_db, self.queue_size)
+        self.skipped_ranges = []
+        progress = {"last_inserted_slot": start_slot - 1}
+
+        workers = [
+            threading.Thread(
+                target=self._download_worker, args=(scheduler, node), daemon=True
+            )
+            for node in range(node_count)
+            for _ in range(min(self.download_workers, len(chunks)))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            try:
+                for index, (chunk_start, chunk_end) in enumerate(chunks):
+                    try:
+                        block_rewards, slot_features = scheduler.result(index)
+                    except EndSlotUnkown:
+                        logging.info(f"End slot {chunk_end} unknown, stopping backfill")
+                        break
+                    if inserter.error is not None:
+                        break
+                    self.update_model()
+                    if block_rewards is None and slot_features is not None:
+                        # Read from the feature store, reclassify.py can use it
+                        # for the features not stored in Clickhouse
+                        guesses = buildSlotGuessesFromFeatures(
+                            chunk_start,
+                            chunk_end,
+                            slot_features,
+                            self.classifier,
+                            db_format=True,
+                        )
+                        feature_columns = None
+                    elif block_rewards is None:
+                        self._skip(chunk_start, chunk_end, "the nodes refused them")
+                        continue
+                    else:
+                        guesses = buildSlotGuesses(
+                            chunk_start,
+                            chunk_end,
+                            block_rewards,
+                            self.classifier,
+                            self.model_folder,
+                            self.add_to_model,
+                            db_format=True,
+                        )
+                        if slot_features is not None:
+                            self._store_chunk(chunk_start, chunk_end, slot_features)
+                        feature_columns = self._feature_columns(
+                            block_rewards, slot_features
+                        )
+                    if guesses is None:
+                        self._skip(
+                            chunk_start, chunk_end, "a block could not be classified"
+                        )
+                        continue
+                    inserter.submit(
+                        convert_to_columns(guesses, self.model_version),
+                        lambda slot=chunk_end: progress.update(last_inserted_slot=slot),
+                        feature_columns,
+                    )
+            finally:
+                # Workers exit once their current download is done
+                scheduler.stop()
+            inserter.flush()
+        finally:
+            inserter.close()
+        return progress["last_inserted_slot"]
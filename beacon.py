@@ -0,0 +1,211 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+CONNECT_TIMEOUT = 5
+# Block rewards of a large range take a while to compute on the node
+READ_TIMEOUT = 120
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Consecutive failures opening a node's circuit, and seconds before it is tried again
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+LATENCY_SMOOTHING = 0.2
+# Share of requests sent to a random node to keep the latencies of the others fresh
+EXPLORE_PROBABILITY = 0.05
+
+
+class BeaconNodeUnavailable(Exception):
+    pass
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    # Exponential backoff with full jitter, attempt starts at 0
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+
+def split_node_urls(node_url):
+    return [url.strip().rstrip("/") for url in node_url.split(",") if url.strip()]
+
+
+class BeaconNode:
+    """
+    One beacon node: its pooled session, a circuit breaker and a moving
+    average of its time to response headers. The circuit opens after FAILURE_THRESHOLD
+    consecutive failures; the node then gets no requests until RESET_TIMEOUT
+    seconds later, when a single trial request decides if it closes again.
+    """
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.latency = None
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def acquire(self, now):
+        # Whether a request can be sent now, claiming the trial if half-open
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if now - self.opened_at < RESET_TIMEOUT or self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self, latency):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.failures = 0
+            if self.opened_at is not None:
+                logging.info(f"Beacon node {self.url} is back")
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= FAILURE_THRESHOLD:
+                if self.opened_at is None:
+                    logging.error(
+                        f"Beacon node {self.url} failed {self.failures} times in a row, pausing requests to it for {RESET_TIMEOUT} seconds"
+                    )
+                self.opened_at = time.monotonic()
+
+
+class BeaconClient:
+    """
+    Beacon API client over one or more nodes (`node_url` may list several,
+    separated by commas). Requests go to the available node with the lowest
+    average latency. Connection errors, timeouts and 5xx responses are
+    retried on the next best node with jittered exponential backoff; 4xx
+    responses are raised right away as requests' HTTPError.
+    """
+
+    def __init__(
+        self,
+        node_url,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        retries=DEFAULT_RETRIES,
+    ):
+        self.nodes = [BeaconNode(url, pool_size) for url in split_node_urls(node_url)]
+        if len(self.nodes) == 0:
+            raise ValueError(f"No beacon node URL in {node_url!r}")
+        self.timeout = timeout
+        self.retries = retries
+
+    def pick_node(self, exclude=()):
+        now = time.monotonic()
+        candidates = [node for node in self.nodes if node not in exclude]
+        if len(candidates) > 1 and random.random() < EXPLORE_PROBABILITY:
+            random.shuffle(candidates)
+        else:
+            # Nodes without a latency yet are tried first
+            candidates.sort(key=lambda node: node.latency or 0)
+        for node in candidates:
+            if node.acquire(now):
+                return node
+        return None
+
+    def get(
+        self, path, params=None, headers=None, timeout=None, stream=False, retries=None
+    ):
+        if retries is None:
+            retries = self.retries
+        last_error = None
+        failed_nodes = set()
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff_delay(attempt - 1))
+            # Prefer a node that hasn't failed this request yet
+            node = self.pick_node(failed_nodes) or self.pick_node()
+            if node is None:
+                last_error = BeaconNodeUnavailable(
+                    "All beacon nodes failed recently, waiting before retrying them"
+                )
+                continue
+            try:
+                response = node.session.get(
+                    node.url + path,
+                    params=params,
+                    headers=headers,
+                    timeout=timeout or self.timeout,
+                    stream=stream,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logging.error(f"Request to {node.url}{path} failed: {e}")
+                node.record_failure()
+                failed_nodes.add(node)
+                last_error = e
+                continue
+            if response.status_code >= 500:
+                logging.error(
+                    f"Request to {node.url}{path} failed with status {response.status_code}"
+                )
+                node.record_failure()
+                failed_nodes.add(node)
+                last_error = requests.HTTPError(
+                    f"{response.status_code} Server Error for url: {response.url}",
+                    response=response,
+                )
+                response.close()
+                continue
+            # A 4xx answer still means the node is up. Latencies are measured up
+            # to the headers, the body of streamed responses is read later
+            node.record_success(response.elapsed.total_seconds())
+            response.raise_for_status()
+            return response
+        raise last_error
+
+    def get_json(self, path, params=None):
+        return self.get(path, params).json()
+
+    def block_rewards(self, start_slot, end_slot):
+        return self.get_json(
+            "/lighthouse/analysis/block_rewards",
+            {"start_slot": start_slot, "end_slot": end_slot},
+        )
+
+    def header_slot(self, block_id):
+        header = self.get_json(f"/eth/v1/beacon/headers/{block_id}")
+        return int(header["data"]["header"]["message"]["slot"])
+
+    def genesis_time(self):
+        # Unix time of the network's first slot
+        genesis = self.get_json("/eth/v1/beacon/genesis")
+        return int(genesis["data"]["genesis_time"])
+
+    def close(self):
+        for node in self.nodes:
+            node.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_beacon_client(node_url):
+    # One client per node_url, and none inherited from the parent process
+    # since pooled connections can't be shared with forked workers
+    key = (os.getpid(), node_url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = BeaconClient(node_url)
+        return _clients[key]
@@ -1,19 +1,10 @@
 #!/usr/bin/env python3
 
-import time
+import logging
 from getGuesses import getBlockprintGuesses
-from dataClasses import ProbabilityMapArray
 from Plot import Plot
 from Parser import Parser
 
-clients = [
-    "Lighthouse",
-    "Lodestar",
-    "Nimbus",
-    "Prysm",
-    "Teku"
-]
-
 
 class Comparer:
     def __init__(self, parser: Parser):
@@ -32,35 +23,26 @@ class Comparer:
             plotResults()
 
         # get the matching percentage and print it
-        matchingPercentage = rocketDF.match.value_counts()[
-            True] / len(rocketDF) * 100
+        matchingPercentage = rocketDF['match'].mean() * 100
         print('\nWe have a matching percentage of {:.2f}%\n'.format(
             matchingPercentage))
 
     def compareGuesses(self, rocketDF, bestGuesses):
         '''
         Compare the guesses from the Blockprint API to the parsed clients from the rocket-pool-proposals data
-        return: a list of booleans, True if the guess is matching, False otherwise
+        return: the blocks we have known clients and guesses for, with a 'match' column True if the guess
+        is matching, the guess in 'model_guess' when it is not, and the 'proba_<client>' columns of the guesses
         '''
 
-        # initialize the lists to gain time
-        matches = [True] * len(rocketDF)
-        wrongGuesses = [None] * len(rocketDF)
-        proba_map_array = ProbabilityMapArray()
-
-        # compare the guesses for the blocks we have known clients for
-        # and add the result to the list in order to add it to the dataframe
-        for i in range(len(rocketDF)):
-            block_guess = bestGuesses[rocketDF['f_slot'].iloc[i]]
-            matches[i] = rocketDF['f_client'].iloc[i] in block_guess.best_guess_single
-
-            proba_map = block_guess.probability_map
-            proba_map_array.add_elem(*proba_map.values())
-
-            if not matches[i]:
-                wrongGuesses[i] = block_guess.best_guess_single
+        # join the guesses to the blocks we have known clients for, on the slot
+        resultDF = rocketDF.merge(bestGuesses, on='f_slot', how='inner', validate='many_to_one')
+        missing = len(rocketDF) - len(resultDF)
+        if missing > 0:
+            logging.warning(f"No guess for {missing} of the {len(rocketDF)} blocks, they are left out")
 
-        return matches, wrongGuesses, proba_map_array
+        resultDF['match'] = resultDF['f_client'] == resultDF['best_guess_single']
+        resultDF['model_guess'] = resultDF['best_guess_single'].where(~resultDF['match'])
+        return resultDF.drop(columns=['best_guess_single'])
 
     def compareResults(self, arguments):
         '''
@@ -73,19 +55,15 @@ class Comparer:
         # x being the number of rows
         rocketDF = self._parser.parseClients(arguments) # .head(x)
 
-        # get the first and last block of the dataset and  get the best guesses from the API
-        init_block, end_block = rocketDF['f_slot'].iloc[0], rocketDF['f_slot'].iloc[-1]
-        bestGuesses = getBlockprintGuesses(init_block, end_block + 1, arguments.api_url)
+        # get the best guesses of the blocks of the dataset
+        bestGuesses = getBlockprintGuesses(
+            rocketDF['f_slot'], source=arguments.source, api_url=arguments.api_url,
+            clickhouse_endpoint=arguments.clickhouse_endpoint, model_version=arguments.model_version,
+            cache_path=arguments.cache, chunk_size=arguments.chunk_size, workers=arguments.workers,
+            retries=arguments.retries)
 
         # compare the guesses and add the result to the dataframe
-        matching, wrongGuesses, probaMap = self.compareGuesses(
-            rocketDF, bestGuesses)
-        rocketDF['match'] = matching
-        rocketDF['model_guess'] = wrongGuesses
-
-        allProbabilities = probaMap.getLists()
-        for i, client in enumerate(clients):
-            rocketDF[f'proba_{client}'] = allProbabilities[i]
+        rocketDF = self.compareGuesses(rocketDF, bestGuesses)
 
         if arguments.save:
             rocketDF.to_csv('result.csv')
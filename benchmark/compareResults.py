@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 
 from Compare import Comparer
 from Parser import Parser
+from getGuesses import GuessFetchError
 
 load_dotenv()
 
@@ -34,7 +35,11 @@ def main():
         start = time.time()
 
     comparer = Comparer(parser)
-    finalDF = comparer.compareResults(arguments)
+    try:
+        finalDF = comparer.compareResults(arguments)
+    except GuessFetchError as e:
+        logging.error(e)
+        exit(1)
 
     if arguments.timer:
         # end timer
@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import json
 import logging
+import os
 import sys
+import threading
 import time
+import numpy as np
+import pandas as pd
 import requests
 
-from dataClasses import BlockGuess
+clients = [
+    "Lighthouse",
+    "Lodestar",
+    "Nimbus",
+    "Prysm",
+    "Teku"
+]
+
+SOURCES = ["api", "clickhouse", "cache"]
+# MAX_SLOTS of the server, longer ranges get truncated
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1
+REQUEST_TIMEOUT = 60
+
+
+class GuessFetchError(Exception):
+    pass
 
 
 def get_validator_proposed_blocks(init_block, end_block, api_url):
@@ -16,35 +39,160 @@ def get_validator_proposed_blocks(init_block, end_block, api_url):
     '''
 
     url = f"{api_url}/{init_block}/{end_block}"
-    response = requests.get(url)
+    response = requests.get(url, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
 
     return json.loads(response.text)
 
 
-def getBlockprintGuesses(init_block, end_block, api_url):
+def clickhouseFetcher(clickhouse_endpoint, model_version):
+    '''
+    Get the best guesses stored by load_db.py instead of calling the API
+    return: a function returning the guesses of the given slots between init_block and end_block,
+    in the same format as the API
+    '''
+
+    # the database module of the indexer, one level up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from clickhouse import ClickHouseDB
+
+    # clickhouse-connect clients can't run queries concurrently, each thread gets its own
+    local = threading.local()
+
+    def fetch(init_block, end_block, slots):
+        if not hasattr(local, 'db'):
+            local.db = ClickHouseDB(clickhouse_endpoint)
+        return local.db.get_client_guesses(init_block, end_block - 1, clients, model_version,
+                                           slots=slots.tolist())
+    return fetch
+
+
+def split_sparse_chunks(slots, chunk_size):
+    '''
+    Split the sorted slots into the ranges to request, each starting at a slot and spanning
+    at most chunk_size slots, so the gaps between the slots are never requested
+    return: a list of (init_block, end_block, slots) with end_block excluded
+    '''
+
+    chunks = []
+    first = 0
+    while first < len(slots):
+        init_block = int(slots[first])
+        last = np.searchsorted(slots, init_block + chunk_size, side='left')
+        chunks.append((init_block, int(slots[last - 1]) + 1, slots[first:last]))
+        first = last
+    return chunks
+
+
+def guessesToDataFrame(block_guesses, slots):
+    '''
+    Convert the guesses from the API to a dataframe, keeping only the blocks of the given slots
+    return: a dataframe with one row per block: 'f_slot', 'best_guess_single'
+    and a 'proba_<client>' column for each client
+    '''
+
+    # empty slots have no guess and no probability map
+    block_guesses = [block for block in block_guesses
+                     if block['best_guess_single'] and isinstance(block['probability_map'], dict)]
+    # build the columns directly, the probability maps are expanded into one column per client
+    guesses = pd.DataFrame({
+        'f_slot': pd.array([block['slot'] for block in block_guesses], dtype='int64'),
+        'best_guess_single': [block['best_guess_single'] for block in block_guesses],
+    })
+    probabilities = pd.DataFrame.from_records(
+        [block['probability_map'] for block in block_guesses], columns=clients)
+    for client in clients:
+        guesses[f'proba_{client}'] = probabilities[client].fillna(0).to_numpy()
+    return guesses[guesses['f_slot'].isin(slots)]
+
+
+def fetchWithRetry(fetch, init_block, end_block, slots, retries):
+    for attempt in range(retries + 1):
+        try:
+            return fetch(init_block, end_block, slots)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            logging.warning(f"Error requesting guesses from {init_block} to {end_block}, retrying in {delay} seconds: {e}")
+            time.sleep(delay)
+
+
+def readCache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    return pd.read_csv(cache_path, dtype={'f_slot': 'int64'})
+
+
+def writeCache(cache_path, guesses):
+    # renamed once complete, so an interrupted run doesn't leave a partial cache
+    tmp_path = f"{cache_path}.tmp"
+    guesses.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+
+
+def getBlockprintGuesses(slots, source="api", api_url=None, clickhouse_endpoint=None, model_version=None,
+                         cache_path=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS,
+                         retries=DEFAULT_RETRIES):
     '''
-    Get the best guesses from the Blockprint API
-    return: a dictionary with the block slot as key and the best guess as value
+    Get the best guesses for the given slots from the Blockprint API, from the Clickhouse database
+    filled by load_db.py or from the cache only. The slots are requested in ranges of at most
+    chunk_size slots, concurrently, skipping the gaps between the slots. With cache_path, the slots
+    already in the cache aren't requested again and the new guesses are added to it.
+    return: a dataframe with one row per block: 'f_slot', 'best_guess_single'
+    and a 'proba_<client>' column for each client
     '''
 
     logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
-    logging.basicConfig(level=logging.ERROR, format='%(levelname)s - %(message)s')
 
-    guesses = {}
-    # call to the API to get the guesses
-    logging.info(f"Getting guesses from {init_block} to {end_block}...")
+    slots = np.unique(np.asarray(slots, dtype=np.int64))
+    wanted = slots
+    cached = readCache(cache_path)
+    if cached is not None:
+        slots = slots[~np.isin(slots, cached['f_slot'].to_numpy())]
+        logging.info(f"{len(wanted) - len(slots)} guesses read from {cache_path}")
+    if source == "cache":
+        if cached is None:
+            raise GuessFetchError(f"No cache at {cache_path}")
+        if len(slots) > 0:
+            logging.warning(f"{len(slots)} slots are not in the cache")
+        return cached[cached['f_slot'].isin(wanted)].sort_values(by=['f_slot']).reset_index(drop=True)
+
+    if source == "api":
+        fetch = lambda init_block, end_block, _: get_validator_proposed_blocks(init_block, end_block, api_url)
+    elif source == "clickhouse":
+        fetch = clickhouseFetcher(clickhouse_endpoint, model_version)
+    else:
+        raise GuessFetchError(f"Unknown source {source}, expected one of {SOURCES}")
+
+    chunks = split_sparse_chunks(slots, chunk_size)
+    logging.info(f"Getting guesses for {len(slots)} slots in {len(chunks)} requests...")
     start = time.time()
-    try:
-        block_guesses = get_validator_proposed_blocks(init_block, end_block, api_url)
-    except Exception as e:
-        logging.error(f"Error requesting guesses from {init_block} to {end_block}: {e}")
-        exit(1)
+    frames = [] if cached is None else [cached]
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetchWithRetry, fetch, init_block, end_block, chunk_slots, retries):
+                (init_block, end_block, chunk_slots)
+            for init_block, end_block, chunk_slots in chunks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            init_block, end_block, chunk_slots = futures[future]
+            try:
+                frames.append(guessesToDataFrame(future.result(), chunk_slots))
+            except Exception as e:
+                logging.error(f"Error requesting guesses from {init_block} to {end_block}: {e}")
+                failures.append((init_block, end_block))
 
+    guesses = pd.concat(frames, ignore_index=True) if frames else guessesToDataFrame([], slots)
+    guesses = guesses.sort_values(by=['f_slot']).reset_index(drop=True)
     end = time.time()
     logging.info("Getting guesses took %.2f seconds" % (end - start))
 
-    # get the guess for each block and add it to the dictionary with the slot as key
-    for block in block_guesses:
-        guesses[block['slot']] = BlockGuess.from_json(block)
-    return guesses
+    # saved even if some requests failed, so that running again only requests those
+    if cache_path is not None:
+        writeCache(cache_path, guesses)
+    if failures:
+        raise GuessFetchError(f"Failed to get the guesses of {len(failures)} of {len(chunks)} ranges: "
+                              + ", ".join(f"{init_block} to {end_block}" for init_block, end_block in failures))
+    return guesses[guesses['f_slot'].isin(wanted)].reset_index(drop=True)
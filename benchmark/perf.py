@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and latency benchmark of the classification and indexing path.
+
+Recorded block rewards are served by a stub beacon node in this process, and
+every stage of the indexer and the server is run against them: downloading,
+classifying, inserting, the whole backfill pipeline and /getClientGuess.
+Guesses are inserted into an in-memory stand-in for Clickhouse, or into a
+local Clickhouse with --clickhouse-endpoint. Run from the repository root:
+
+    python -m benchmark.perf training_data/ --batch-sizes 256,1000,4000
+
+Results are written as JSON, and compared to the results of another commit
+with --compare.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+STAGES = [
+    "download",
+    "classify",
+    "classify_single",
+    "get_slot_guesses",
+    "insert",
+    "backfill",
+    "server",
+]
+DEFAULT_BATCH_SIZES = "1000"
+DEFAULT_MODEL_FOLDER = "model"
+DEFAULT_SINGLE_BLOCKS = 1000
+DEFAULT_SERVER_REQUESTS = 200
+DEFAULT_SERVER_SLOTS = 32
+# Model version the benchmark's guesses are inserted under
+PERF_MODEL_VERSION = "perf"
+
+# Progress is logged at INFO level while the stages only log warnings and errors
+logger = logging.getLogger("perf")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput and latency of downloading, classifying and inserting recorded blocks"
+    )
+    parser.add_argument(
+        "fixtures",
+        nargs="+",
+        type=str,
+        help="JSON files of block rewards, or folders of them, such as the files downloaded by prepare_training_data.py",
+    )
+    parser.add_argument(
+        "--model-folder",
+        default=DEFAULT_MODEL_FOLDER,
+        type=str,
+        help=f"Path to the folder with model files (default: {DEFAULT_MODEL_FOLDER})",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        help="Path to a classifier snapshot to use instead of training the classifier from the model folder. It is created from the model folder if it doesn't exist",
+    )
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        type=str,
+        help=f"Comma-separated stages to run (default: {','.join(STAGES)})",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        default=DEFAULT_BATCH_SIZES,
+        type=str,
+        help=f"Comma-separated numbers of slots per chunk to run the chunked stages with, e.g. to tune the --batch-size of load_db.py (default: {DEFAULT_BATCH_SIZES})",
+    )
+    parser.add_argument(
+        "--node-latency",
+        default=0.0,
+        type=float,
+        help="Seconds the stub beacon node waits before answering each request, to simulate a remote node (default: 0)",
+    )
+    parser.add_argument(
+        "--clickhouse-endpoint",
+        type=str,
+        help=f"Insert into this Clickhouse instead of an in-memory stand-in. Use a scratch database, guesses are inserted under model version {PERF_MODEL_VERSION!r}",
+    )
+    parser.add_argument(
+        "--single-blocks",
+        default=DEFAULT_SINGLE_BLOCKS,
+        type=int,
+        help=f"Number of blocks classified one at a time by the classify_single stage (default: {DEFAULT_SINGLE_BLOCKS})",
+    )
+    parser.add_argument(
+        "--server-requests",
+        default=DEFAULT_SERVER_REQUESTS,
+        type=int,
+        help=f"Number of /getClientGuess requests of the server stage (default: {DEFAULT_SERVER_REQUESTS})",
+    )
+    parser.add_argument(
+        "--server-slots",
+        default=DEFAULT_SERVER_SLOTS,
+        type=int,
+        help=f"Number of slots per /getClientGuess request (default: {DEFAULT_SERVER_SLOTS})",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path of the JSON results (default: perf-<commit>.json)",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        metavar="BASELINE",
+        help="JSON results of an earlier run to compare these ones to",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Keep the logs of the stages",
+    )
+    return parser.parse_args()
+
+
+def load_fixtures(paths):
+    # Block rewards of every file, in slot order, one per slot
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(".json") and not name.startswith(".")
+            )
+        else:
+            files.append(path)
+    block_rewards = {}
+    for file in files:
+        with open(file) as f:
+            for block_reward in json.load(f):
+                block_rewards[int(block_reward["meta"]["slot"])] = block_reward
+    if len(block_rewards) == 0:
+        raise ValueError(f"No block rewards in {', '.join(paths)}")
+    return [block_rewards[slot] for slot in sorted(block_rewards)]
+
+
+class StubBeaconNode:
+    """
+    Serves the block rewards endpoint and the head and finalized headers of
+    the beacon API from recorded block rewards, on a local port. Slots
+    without a recorded block are missed slots, and the last recorded slot is
+    the head.
+    """
+
+    def __init__(self, block_rewards, latency=0.0):
+        # Serialized once, so the stub takes as little CPU from the benchmark as possible
+        self.slots = np.array(
+            [int(block_reward["meta"]["slot"]) for block_reward in block_rewards]
+        )
+        self.encoded = [
+            json.dumps(block_reward).encode() for block_reward in block_rewards
+        ]
+        self.latency = latency
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if node.latency > 0:
+                    time.sleep(node.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                head_slot = int(node.slots[-1])
+                if url.path == "/lighthouse/analysis/block_rewards":
+                    start_slot = int(query["start_slot"][0])
+                    end_slot = int(query["end_slot"][0])
+                    if end_slot > head_slot:
+                        return self.send(
+                            400,
+                            json.dumps(
+                                {
+                                    "code": 400,
+                                    "message": f"BAD_REQUEST: block at end slot {end_slot} unknown",
+                                }
+                            ).encode(),
+                        )
+                    first = np.searchsorted(node.slots, start_slot, side="left")
+                    last = np.searchsorted(node.slots, end_slot, side="right")
+                    return self.send(
+                        200, b"[" + b",".join(node.encoded[first:last]) + b"]"
+                    )
+                if url.path.startswith("/eth/v1/beacon/headers/"):
+                    header = {"data": {"header": {"message": {"slot": str(head_slot)}}}}
+                    return self.send(200, json.dumps(header).encode())
+                self.send(404, b'{"code": 404, "message": "NOT_FOUND"}')
+
+            def send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MemoryDB:
+    """
+    Stand-in for ClickHouseDB with the insert methods the indexer uses. Rows
+    are counted and dropped, so inserts only measure building the columns.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = {"guesses": 0, "features": 0} if counts is None else counts
+
+    def clone(self):
+        return MemoryDB(self.counts)
+
+    def insert_client_guess_columns(self, columns):
+        self.counts["guesses"] += len(columns["f_slot"])
+
+    def insert_slot_feature_columns(self, columns):
+        self.counts["features"] += len(columns["f_slot"])
+
+    def insert_client_guesses(self, guesses, model_version=""):
+        from clickhouse import convert_to_columns
+
+        self.insert_client_guess_columns(convert_to_columns(guesses, model_version))
+
+    def set_active_model_version(self, model_version):
+        pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def run_stage(stage, batch_size, calls, call):
+    """
+    Time `call` on each item of `calls`, returning the stats of the stage.
+    `call` returns the (slots, blocks) it handled.
+    """
+    logger.info(
+        f"Running {stage}"
+        + (f" with batches of {batch_size} slots" if batch_size else "")
+        + "..."
+    )
+    latencies = []
+    slots = 0
+    blocks = 0
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    for item in calls:
+        call_start = time.perf_counter()
+        call_slots, call_blocks = call(item)
+        latencies.append(time.perf_counter() - call_start)
+        slots += call_slots
+        blocks += call_blocks
+    seconds = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "stage": stage,
+        "batch_size": batch_size,
+        "calls": len(latencies),
+        "slots": slots,
+        "blocks": blocks,
+        "seconds": round(seconds, 4),
+        "slots_per_second": round(slots / seconds, 1) if seconds > 0 else None,
+        "blocks_per_second": round(blocks / seconds, 1) if seconds > 0 else None,
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3)
+        if latencies
+        else None,
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3)
+        if latencies
+        else None,
+        # High-water mark of the process, and how much this stage raised it
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_growth_mb": round(peak_rss_mb() - rss_before, 1),
+    }
+
+
+def run_batch_stages(stages, batch_size, block_rewards, classifier, node, db):
+    from backfill import BackfillPipeline
+    from clickhouse import convert_to_columns
+    from guess_requester import (
+        buildSlotGuesses,
+        classify_block_rewards,
+        downloadSlotBlockRewards,
+        getSlotGuesses,
+        split_slot_range,
+    )
+
+    start_slot = int(node.slots[0])
+    end_slot = int(node.slots[-1])
+    chunks = split_slot_range(start_slot, end_slot, batch_size)
+
+    def chunk_rewards(chunk_start, chunk_end):
+        first = np.searchsorted(node.slots, chunk_start, side="left")
+        last = np.searchsorted(node.slots, chunk_end, side="right")
+        return block_rewards[first:last]
+
+    results = []
+    if "download" in stages:
+
+        def download(chunk):
+            rewards = downloadSlotBlockRewards(*chunk, node.url)
+            return chunk[1] - chunk[0] + 1, len(rewards)
+
+        results.append(run_stage("download", batch_size, chunks, download))
+
+    if "classify" in stages:
+
+        def classify(chunk):
+            rewards = chunk_rewards(*chunk)
+            classify_block_rewards(classifier, rewards)
+            return chunk[1] - chunk[0] + 1, len(rewards)
+
+        results.append(run_stage("classify", batch_size, chunks, classify))
+
+    if "get_slot_guesses" in stages:
+
+        def get_slot_guesses(chunk):
+            guesses = getSlotGuesses(*chunk, classifier, node_url=node.url)
+            return len(guesses), sum(
+                1 for guess in guesses if guess["best_guess_single"]
+            )
+
+        results.append(
+            run_stage("get_slot_guesses", batch_size, chunks, get_slot_guesses)
+        )
+
+    if "insert" in stages:
+        # Classified beforehand, only the inserts are timed
+        guesses = [
+            buildSlotGuesses(*chunk, chunk_rewards(*chunk), classifier, db_format=True)
+            for chunk in chunks
+        ]
+
+        def insert(chunk_guesses):
+            db.insert_client_guess_columns(
+                convert_to_columns(chunk_guesses, PERF_MODEL_VERSION)
+            )
+            return len(chunk_guesses), sum(1 for guess in chunk_guesses if guess[1])
+
+        results.append(run_stage("insert", batch_size, guesses, insert))
+
+    if "backfill" in stages:
+
+        def backfill(chunk):
+            pipeline = BackfillPipeline(
+                classifier,
+                db,
+                node.url,
+                chunk_size=batch_size,
+                model_version=PERF_MODEL_VERSION,
+            )
+            last_slot = pipeline.run(*chunk)
+            return last_slot - chunk[0] + 1, len(chunk_rewards(chunk[0], last_slot))
+
+        # A single call over the whole range, its latency is the total time
+        results.append(
+            run_stage("backfill", batch_size, [(start_slot, end_slot)], backfill)
+        )
+    return results
+
+
+def run_single_stages(stages, args, block_rewards, classifier, node):
+    results = []
+    if "classify_single" in stages:
+
+        def classify_single(block_reward):
+            classifier.classify(block_reward)
+            return 1, 1
+
+        results.append(
+            run_stage(
+                "classify_single",
+                None,
+                block_rewards[: args.single_blocks],
+                classify_single,
+            )
+        )
+
+    if "server" in stages:
+        import server
+
+        server.classifier = classifier
+        server.node_url = node.url
+        server.model_folder = args.model_folder
+        server.add_to_model = False
+        client = server.create_app().test_client()
+        start_slot = int(node.slots[0])
+        end_slot = int(node.slots[-1])
+        # The same ranges from one run to the next
+        rng = random.Random(0)
+        request_starts = [
+            rng.randint(start_slot, max(start_slot, end_slot - args.server_slots + 1))
+            for _ in range(args.server_requests)
+        ]
+
+        def request(request_start):
+            request_end = min(request_start + args.server_slots - 1, end_slot)
+            response = client.get(
+                f"/getClientGuess?start_slot={request_start}&end_slot={request_end}"
+            )
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"/getClientGuess failed with status {response.status_code}: {response.get_data(as_text=True)}"
+                )
+            guesses = response.get_json()
+            return len(guesses), sum(
+                1 for guess in guesses if guess["best_guess_single"]
+            )
+
+        results.append(run_stage("server", None, request_starts, request))
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty != ""
+
+
+def print_results(results):
+    print(
+        f"{'stage':<18}{'batch':>7}{'calls':>7}{'slots/s':>12}{'blocks/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['stage']:<18}{result['batch_size'] or '-':>7}{result['calls']:>7}"
+            f"{result['slots_per_second'] or 0:>12.1f}{result['blocks_per_second'] or 0:>12.1f}"
+            f"{result['p50_ms'] or 0:>10.2f}{result['p99_ms'] or 0:>10.2f}{result['peak_rss_mb']:>10.1f}"
+        )
+
+
+def print_comparison(results, fixtures, config, baseline):
+    # Matched on stage and batch size, positive changes of slots/s are faster
+    baseline_results = {
+        (result["stage"], result["batch_size"]): result
+        for result in baseline["results"]
+    }
+    print(f"\nCompared to {baseline.get('commit') or 'the baseline'}:")
+    if baseline.get("fixtures") != fixtures or baseline.get("config") != config:
+        print(
+            "The baseline ran with other fixtures or options, the numbers may not compare"
+        )
+    print(f"{'stage':<18}{'batch':>7}{'slots/s':>12}{'p99 ms':>12}")
+    for result in results:
+        previous = baseline_results.get((result["stage"], result["batch_size"]))
+        if previous is None:
+            continue
+        changes = []
+        for key in ("slots_per_second", "p99_ms"):
+            if result[key] is None or not previous.get(key):
+                changes.append("-")
+            else:
+                changes.append(f"{100 * (result[key] / previous[key] - 1):+.1f}%")
+        print(
+            f"{result['stage']:<18}{result['batch_size'] or '-':>7}{changes[0]:>12}{changes[1]:>12}"
+        )
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(levelname)s - %(message)s",
+    )
+    logger.setLevel(logging.INFO)
+    stages = args.stages.split(",")
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        logging.error(f"Unknown stages {sorted(unknown_stages)}, expected {STAGES}")
+        exit(1)
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(",")]
+
+    from load_db import train_classifier
+    from snapshot import load_or_create_snapshot
+
+    block_rewards = load_fixtures(args.fixtures)
+    logger.info(f"Loaded {len(block_rewards)} recorded blocks")
+    start = time.perf_counter()
+    if args.snapshot:
+        classifier = load_or_create_snapshot(
+            args.snapshot, lambda: train_classifier(args.model_folder)
+        )
+    else:
+        classifier = train_classifier(args.model_folder)
+    model_load_seconds = time.perf_counter() - start
+
+    if args.clickhouse_endpoint:
+        from clickhouse import ClickHouseDB
+
+        db = ClickHouseDB(args.clickhouse_endpoint)
+        db.create_table()
+    else:
+        db = MemoryDB()
+
+    node = StubBeaconNode(block_rewards, args.node_latency)
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            results.extend(
+                run_batch_stages(
+                    stages, batch_size, block_rewards, classifier, node, db
+                )
+            )
+        results.extend(run_single_stages(stages, args, block_rewards, classifier, node))
+    finally:
+        node.close()
+
+    commit, dirty = git_commit()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model_version": getattr(classifier, "fingerprint", None),
+        "model_load_seconds": round(model_load_seconds, 3),
+        "fixtures": {
+            "blocks": len(block_rewards),
+            "start_slot": int(node.slots[0]),
+            "end_slot": int(node.slots[-1]),
+        },
+        "config": {
+            "node_latency": args.node_latency,
+            "database": "clickhouse" if args.clickhouse_endpoint else "memory",
+            "single_blocks": args.single_blocks,
+            "server_requests": args.server_requests,
+            "server_slots": args.server_slots,
+        },
+        "results": results,
+    }
+    output = args.output or f"perf-{(commit or 'unknown')[:12]}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(
+                results, report["fixtures"], report["config"], json.load(f)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+DEFAULT_MIN_BATCH_SIZE = 16
+
+# Classifier of a worker process, by snapshot path, only the latest is kept
+_worker_classifiers = {}
+
+
+def _classify_batch(snapshot_path, block_rewards):
+    # Runs in a worker process
+    from guess_requester import classify_block_rewards
+    from snapshot import load_snapshot
+
+    classifier = _worker_classifiers.get(snapshot_path)
+    if classifier is None:
+        _worker_classifiers.clear()
+        classifier = load_snapshot(snapshot_path)
+        _worker_classifiers[snapshot_path] = classifier
+    return classify_block_rewards(classifier, block_rewards)
+
+
+def add_classify_workers_argument(parser):
+    parser.add_argument(
+        "--classify-workers",
+        default=0,
+        type=int,
+        help="Number of processes classifying the downloaded blocks in parallel, 0 to classify them in this process. Needs a classifier snapshot, which the processes map instead of loading their own copy of the model (default: 0)",
+    )
+
+
+class ClassifierPool:
+    """
+    Spreads the classification of block rewards over `workers` processes.
+    Workers load the classifier from its snapshot, whose arrays are memory
+    mapped, so they share the model through the page cache instead of each
+    holding a copy. A classifier swapped for a retrained snapshot is picked
+    up by the workers on their next batch. Blocks are split into one batch
+    per worker, of at least `min_batch_size` blocks, and the guesses come
+    back in the order of the blocks.
+    """
+
+    def __init__(self, workers, min_batch_size=DEFAULT_MIN_BATCH_SIZE):
+        self.workers = workers
+        self.min_batch_size = min_batch_size
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+
+    def can_classify(self, classifier, block_count):
+        # Other classifiers can't be loaded by the workers, and a single batch
+        # is classified faster without the round trip
+        return (
+            getattr(classifier, "path", None) is not None
+            and block_count >= 2 * self.min_batch_size
+        )
+
+    def _get_executor(self):
+        with self.lock:
+            # Processes don't survive a fork, e.g. into gunicorn workers
+            if self.executor_pid != os.getpid():
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # Spawned rather than forked, the calling process runs threads
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def _reset_executor(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+                self.executor_pid = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def classify(self, classifier, block_rewards):
+        """
+        Guesses for `block_rewards` in the same shape and order as
+        classify_block_rewards, or None if the workers failed.
+        """
+        batch_size = max(self.min_batch_size, -(-len(block_rewards) // self.workers))
+        batches = [
+            block_rewards[batch_start : batch_start + batch_size]
+            for batch_start in range(0, len(block_rewards), batch_size)
+        ]
+        executor = self._get_executor()
+        try:
+            with metrics.STAGE_SECONDS.labels("classify_pool").time():
+                guesses = []
+                for batch_guesses in executor.map(
+                    _classify_batch, [classifier.path] * len(batches), batches
+                ):
+                    guesses.extend(batch_guesses)
+            return guesses
+        except BrokenProcessPool as e:
+            # A worker died, e.g. killed for memory, the next call starts new ones
+            logging.error(f"Classification workers failed: {e}")
+            self._reset_executor(executor)
+            return None
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None and self.executor_pid == os.getpid():
+                self.executor.shutdown()
+            self.executor = None
+            self.executor_pid = None
@@ -1,36 +1,642 @@
-import clickhouse_connect
+import datetime
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+import metrics
 
 TABLE_NAME = "t_slot_client_guesses"
+LEGACY_TABLE_NAME = f"{TABLE_NAME}_legacy"
+CHECKPOINT_TABLE_NAME = "t_indexer_checkpoints"
+FEATURES_TABLE_NAME = "t_slot_features"
+# Checkpoint naming the model version whose guesses are served by default
+ACTIVE_MODEL_CHECKPOINT = "active_model"
+# Checkpoint holding, in place of a slot, the genesis time of the network the
+# day aggregates were built for
+GENESIS_CHECKPOINT = "genesis_time"
+# Every client gets its own probability column, f_prob_<client>
+CLIENTS = ["Grandine", "Lighthouse", "Lodestar", "Nimbus", "Other", "Prysm", "Teku"]
+PROBABILITY_COLUMNS = {client: f"f_prob_{client.lower()}" for client in CLIENTS}
+COLUMN_NAMES = [
+    "f_slot",
+    "f_model_version",
+    "f_best_guess_single",
+    "f_best_guess_multi",
+    *PROBABILITY_COLUMNS.values(),
+    "f_proposer_index",
+]
+FEATURE_COLUMN_NAMES = ["f_slot", "f_proposer_index", "f_graffiti_guess", "f_features"]
+# Aggregates kept up to date by materialized views on TABLE_NAME, keyed by
+# their first column; the day of a slot is its UTC day on the indexed network
+SECONDS_PER_SLOT = 12
+SLOTS_PER_EPOCH = 32
+# Rank of the models that were never active, see model_version_rank
+NEVER_ACTIVE_RANK = 1000000
+AGGREGATE_TABLES = {
+    "proposer": ("t_proposer_client_counts", "f_proposer_index", "UInt64"),
+    "day": ("t_client_shares_daily", "f_day", "Date"),
+    "epoch": ("t_client_shares_epoch", "f_epoch", "UInt64"),
+}
+COMPRESSIONS = ["lz4", "zstd", "none"]
+DEFAULT_COMPRESSION = "lz4"
+DEFAULT_MAX_PENDING_INSERTS = 8
+
+_STOP = object()
+
+
+def genesis_time_expression():
+    # The genesis time the day aggregates were built for
+    return f"""(SELECT argMax(f_slot, f_updated_at)
+        FROM {CHECKPOINT_TABLE_NAME} FINAL
+        WHERE f_name = '{GENESIS_CHECKPOINT}')"""
+
+
+def aggregate_key(aggregate, slot="f_slot", genesis_time=None):
+    """
+    Expression of the key of an aggregate table for the slot expression
+    `slot`. Days are counted from `genesis_time`, by default the one
+    recorded by create_aggregate_tables.
+    """
+    if aggregate == "proposer":
+        return "f_proposer_index"
+    if aggregate == "day":
+        if genesis_time is None:
+            genesis_time = genesis_time_expression()
+        return (
+            f"toDate(toDateTime({genesis_time} + {slot} * {SECONDS_PER_SLOT}, 'UTC'))"
+        )
+    return f"intDiv({slot}, {SLOTS_PER_EPOCH})"
+
+
+def model_version_expression(model_version, parameters):
+    # The given model version, or by default the active model
+    if model_version is None:
+        return f"""(SELECT argMax(f_model_version, f_updated_at)
+            FROM {CHECKPOINT_TABLE_NAME} FINAL
+            WHERE f_name = '{ACTIVE_MODEL_CHECKPOINT}')"""
+    parameters["model_version"] = model_version
+    return "{model_version:String}"
+
+
+def model_version_rank(preferred_version, column="f_model_version"):
+    """
+    Expression ranking the models that classified a slot, the lowest being
+    the one whose guess the slot gets: `preferred_version`, then the models
+    that were active, most recently first, then the others, such as the
+    empty version of the rows written before versions were recorded.
+    """
+    active_versions = f"""(SELECT arrayMap(x -> x.2, arrayReverseSort(groupArray((activated_at, f_model_version))))
+        FROM (
+            SELECT f_model_version, max(f_updated_at) AS activated_at
+            FROM {CHECKPOINT_TABLE_NAME} FINAL
+            WHERE f_name = '{ACTIVE_MODEL_CHECKPOINT}'
+            GROUP BY f_model_version
+        ))"""
+    return f"""multiIf({column} = {preferred_version}, 0,
+        has({active_versions}, {column}), indexOf({active_versions}, {column}),
+        {NEVER_ACTIVE_RANK})"""
 
 
 class ClickHouseDB:
-    def __init__(self, dsn):
-        self.client = clickhouse_connect.get_client(dsn=dsn)
+    def __init__(self, dsn, compression=DEFAULT_COMPRESSION, async_insert=False):
+        self.dsn = dsn
+        self.compression = compression
+        self.async_insert = async_insert
+        import clickhouse_connect
+
+        self.client = clickhouse_connect.get_client(
+            dsn=dsn, compress=False if compression == "none" else compression
+        )
 
-    def create_table(self):
+    def clone(self):
+        # clickhouse-connect clients can't run queries concurrently, so every
+        # thread talking to the database needs its own connection
+        return ClickHouseDB(self.dsn, self.compression, self.async_insert)
+
+    def create_table(self, table_name=TABLE_NAME, genesis_time=None):
+        probability_columns = "".join(
+            f"{column} Float32, " for column in PROBABILITY_COLUMNS.values()
+        )
         self.client.query(
-            f"""CREATE TABLE IF NOT EXISTS {TABLE_NAME}
+            f"""CREATE TABLE IF NOT EXISTS {table_name}
                 (
                     f_slot UInt64,
-                    f_best_guess_single String,
-                    f_best_guess_multi String,
-                    f_probability_map Array(String),
+                    f_model_version LowCardinality(String),
+                    f_best_guess_single LowCardinality(String),
+                    f_best_guess_multi LowCardinality(String),
+                    {probability_columns}
                     f_proposer_index UInt64
                 )
+                ENGINE = ReplacingMergeTree ORDER BY (f_slot, f_model_version)"""
+        )
+        if table_name != TABLE_NAME:
+            return
+        self.create_checkpoint_table()
+        self.create_features_table()
+        if self.is_legacy_table():
+            self.migrate_legacy_table()
+        # Clients added to CLIENTS after the table was created
+        for column in PROBABILITY_COLUMNS.values():
+            self.client.command(
+                f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS {column} Float32"
+            )
+        if not self.has_column(TABLE_NAME, "f_model_version"):
+            # Rows written before model versions were recorded keep an empty one
+            logging.info(f"Adding the model version to {TABLE_NAME}...")
+            self.client.command(
+                f"""ALTER TABLE {TABLE_NAME}
+                    ADD COLUMN f_model_version LowCardinality(String) AFTER f_slot,
+                    MODIFY ORDER BY (f_slot, f_model_version)"""
+            )
+        self.create_aggregate_tables(genesis_time)
+
+    def create_aggregate_tables(self, genesis_time=None):
+        """
+        Per proposer, per day and per epoch blocks of every client, for each
+        model version. Materialized views update them with every insert into
+        TABLE_NAME. Blocks are kept as bitmaps of their slots, so slots
+        inserted again aren't counted twice, and the slots a model hasn't
+        classified can be counted with the guesses of another one.
+
+        Days are counted from `genesis_time`, by default the genesis time
+        recorded by the last call. The day aggregates are rebuilt when it
+        changes, and left out until it is known.
+        """
+        recorded_genesis_time = self.get_checkpoint(GENESIS_CHECKPOINT)
+        if genesis_time is None:
+            genesis_time = recorded_genesis_time
+        for aggregate, (table_name, key, key_type) in AGGREGATE_TABLES.items():
+            view_name = f"{table_name}_mv"
+            slots_type = self.get_column_type(table_name, "f_slots")
+            if aggregate == "day":
+                if genesis_time is None:
+                    logging.warning(
+                        f"Genesis time unknown, {table_name} is created by the indexer"
+                    )
+                    continue
+                if slots_type is not None and genesis_time != recorded_genesis_time:
+                    # Days of another network, or of mainnet before the
+                    # genesis time was recorded
+                    logging.info(
+                        f"Rebuilding {table_name} with the days since genesis time {genesis_time}..."
+                    )
+                    self.client.command(f"DROP VIEW IF EXISTS {view_name}")
+                    self.client.command(f"DROP TABLE {table_name}")
+                    slots_type = None
+                if genesis_time != recorded_genesis_time:
+                    self.set_checkpoint(GENESIS_CHECKPOINT, genesis_time)
+            if slots_type is not None and "groupBitmap" not in slots_type:
+                # Tables of slot counts, which can't be combined across models
+                logging.info(f"Rebuilding {table_name} with the slots of the blocks...")
+                self.client.command(f"DROP VIEW IF EXISTS {view_name}")
+                self.client.command(f"DROP TABLE {table_name}")
+            self.client.command(
+                f"""CREATE TABLE IF NOT EXISTS {table_name}
+                    (
+                        {key} {key_type},
+                        f_model_version LowCardinality(String),
+                        f_client LowCardinality(String),
+                        f_slots AggregateFunction(groupBitmap, UInt64)
+                    )
+                    ENGINE = AggregatingMergeTree ORDER BY ({key}, f_model_version, f_client)"""
+            )
+            if self.client.command(f"EXISTS TABLE {view_name}"):
+                continue
+            select = f"""SELECT {aggregate_key(aggregate, genesis_time=genesis_time)} AS {key}, f_model_version,
+                    f_best_guess_single AS f_client, groupBitmapState(f_slot) AS f_slots
+                FROM {TABLE_NAME}
+                WHERE f_best_guess_single != ''
+                GROUP BY {key}, f_model_version, f_client"""
+            self.client.command(
+                f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view_name} TO {table_name} AS {select}"
+            )
+            # Rows inserted meanwhile are counted once all the same
+            logging.info(f"Filling {table_name} from {TABLE_NAME}...")
+            self.client.command(f"INSERT INTO {table_name} {select}")
+
+    def create_features_table(self):
+        self.client.command(
+            f"""CREATE TABLE IF NOT EXISTS {FEATURES_TABLE_NAME}
+                (
+                    f_slot UInt64,
+                    f_proposer_index UInt64,
+                    f_graffiti_guess LowCardinality(String),
+                    f_features Map(LowCardinality(String), Float64)
+                )
                 ENGINE = ReplacingMergeTree ORDER BY (f_slot)"""
         )
 
+    def create_checkpoint_table(self):
+        self.client.command(
+            f"""CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE_NAME}
+                (
+                    f_name LowCardinality(String),
+                    f_model_version String,
+                    f_slot UInt64,
+                    f_updated_at DateTime64(3)
+                )
+                ENGINE = ReplacingMergeTree(f_updated_at) ORDER BY (f_name, f_model_version)"""
+        )
+
+    def get_checkpoint(self, name, model_version=""):
+        query_res = self.client.query(
+            f"""SELECT f_slot FROM {CHECKPOINT_TABLE_NAME} FINAL
+                WHERE f_name = {{name:String}} AND f_model_version = {{model_version:String}}""",
+            parameters={"name": name, "model_version": model_version},
+        )
+        if len(query_res.result_rows) == 0:
+            return None
+        return query_res.first_row[0]
+
+    def set_checkpoint(self, name, slot, model_version=""):
+        self.client.insert(
+            CHECKPOINT_TABLE_NAME,
+            [[name, model_version, slot, datetime.datetime.now()]],
+            column_names=["f_name", "f_model_version", "f_slot", "f_updated_at"],
+        )
+
+    def get_active_model_version(self):
+        query_res = self.client.query(
+            f"""SELECT argMax(f_model_version, f_updated_at) FROM {CHECKPOINT_TABLE_NAME} FINAL
+                WHERE f_name = '{ACTIVE_MODEL_CHECKPOINT}'"""
+        )
+        return query_res.first_row[0]
+
+    def set_active_model_version(self, model_version):
+        self.set_checkpoint(ACTIVE_MODEL_CHECKPOINT, 0, model_version)
+
+    def has_column(self, table_name, column_name):
+        return self.get_column_type(table_name, column_name) is not None
+
+    def get_column_type(self, table_name, column_name):
+        query_res = self.client.query(
+            """SELECT type FROM system.columns
+                WHERE database = currentDatabase()
+                AND table = {table_name:String}
+                AND name = {column_name:String}""",
+            parameters={"table_name": table_name, "column_name": column_name},
+        )
+        if len(query_res.result_rows) == 0:
+            return None
+        return query_res.first_row[0]
+
+    def is_legacy_table(self):
+        return self.has_column(TABLE_NAME, "f_probability_map")
+
+    def migrate_legacy_table(self):
+        """
+        Move the rows of a table using the old Array(String) probability map
+        ("Client:NN", entries under 20% dropped) into the per-client columns.
+        The old table is kept as LEGACY_TABLE_NAME.
+        """
+        new_table_name = f"{TABLE_NAME}_new"
+        logging.info(f"Migrating {TABLE_NAME} to the per-client probability schema...")
+        self.client.command(f"DROP TABLE IF EXISTS {new_table_name}")
+        self.create_table(new_table_name)
+        probabilities = ", ".join(
+            f"toFloat32(toFloat32OrZero(splitByChar(':', arrayFirst(x -> startsWith(x, '{client}:'), f_probability_map))[2]) / 100)"
+            for client in PROBABILITY_COLUMNS
+        )
+        columns = [name for name in COLUMN_NAMES if name != "f_model_version"]
+        self.client.command(
+            f"""INSERT INTO {new_table_name} ({", ".join(columns)})
+                SELECT f_slot, f_best_guess_single, f_best_guess_multi, {probabilities}, f_proposer_index
+                FROM {TABLE_NAME}"""
+        )
+        self.client.command(
+            f"RENAME TABLE {TABLE_NAME} TO {LEGACY_TABLE_NAME}, {new_table_name} TO {TABLE_NAME}"
+        )
+        logging.info(
+            f"Migrated {TABLE_NAME}, the old table was renamed to {LEGACY_TABLE_NAME}"
+        )
+
     def get_max_slot(self):
         query_res = self.client.query(f"SELECT MAX(f_slot) FROM {TABLE_NAME}")
         return query_res.first_row[0]
 
-    def insert_client_guesses(self, guesses):
-        # guesses = convert_to_clickhouse_format(guesses)
+    def get_missing_slot_ranges(self, start_slot, end_slot):
+        """
+        Ranges of slots between start_slot and end_slot (inclusive) without a
+        row, as (first_missing_slot, last_missing_slot) tuples. Empty slots
+        get a row too, so these are slots that were never indexed.
+        """
+        # Each row is compared with the previous one in a single ordered pass.
+        # Sentinels before start_slot and after end_slot catch missing slots
+        # at both ends of the range
+        query_res = self.client.query(
+            f"""SELECT previous_slot + 1, slot - 1 FROM (
+                    SELECT slot, lagInFrame(slot, 1, {{before_start_slot:Int64}}) OVER (
+                        ORDER BY slot ROWS BETWEEN 1 PRECEDING AND CURRENT ROW
+                    ) AS previous_slot
+                    FROM (
+                        SELECT toInt64(f_slot) AS slot FROM {TABLE_NAME}
+                        WHERE f_slot BETWEEN {{start_slot:UInt64}} AND {{end_slot:UInt64}}
+                        UNION ALL
+                        SELECT {{after_end_slot:Int64}}
+                    )
+                )
+                WHERE slot > previous_slot + 1
+                ORDER BY slot""",
+            parameters={
+                "start_slot": start_slot,
+                "end_slot": end_slot,
+                "before_start_slot": start_slot - 1,
+                "after_end_slot": end_slot + 1,
+            },
+        )
+        return [(int(first), int(last)) for first, last in query_res.result_rows]
+
+    def get_client_guesses(
+        self, start_slot, end_slot, clients=None, model_version=None, slots=None
+    ):
+        """
+        Guesses in the same format as getSlotGuesses, with `clients` in the
+        probability maps. Each slot gets the guess of `model_version`, or by
+        default of the active model, falling back to another model's guess
+        for slots the preferred one hasn't classified (see
+        model_version_rank). With `slots`, only the guesses of those slots of
+        the range are returned.
+        """
+        if clients is None:
+            clients = CLIENTS
+        clients = [client for client in clients if client in PROBABILITY_COLUMNS]
+        columns = [
+            "f_slot",
+            "f_best_guess_single",
+            "f_best_guess_multi",
+            *[PROBABILITY_COLUMNS[client] for client in clients],
+            "f_proposer_index",
+        ]
+        parameters = {"start_slot": start_slot, "end_slot": end_slot}
+        preferred_version = model_version_expression(model_version, parameters)
+        slots_filter = ""
+        if slots is not None:
+            parameters["slots"] = list(slots)
+            slots_filter = "AND f_slot IN {slots:Array(UInt64)}"
+        query_res = self.client.query(
+            f"""SELECT {", ".join(columns)} FROM {TABLE_NAME} FINAL
+                WHERE f_slot BETWEEN {{start_slot:UInt64}} AND {{end_slot:UInt64}}
+                {slots_filter}
+                ORDER BY f_slot, {model_version_rank(preferred_version)}, f_model_version
+                LIMIT 1 BY f_slot""",
+            parameters=parameters,
+        )
+        return [convert_to_guess(row, clients) for row in query_res.named_results()]
+
+    def _aggregate_client_blocks(self, aggregate, key_filter, preferred_version):
+        """
+        Query of (key, f_client, blocks, first_slot, last_slot) for the keys
+        of an aggregate table matching `key_filter`. Like get_client_guesses,
+        each slot is counted once, with the guess of the best ranked model
+        that classified it (see model_version_rank): every model only counts
+        the slots of the models ranked before it didn't classify.
+        """
+        table_name, key, _ = AGGREGATE_TABLES[aggregate]
+        rank = model_version_rank(preferred_version)
+        return f"""WITH
+                clients AS (
+                    SELECT {key}, f_model_version, f_client,
+                        groupBitmapMergeState(f_slots) AS slots
+                    FROM {table_name}
+                    WHERE {key_filter} AND f_client != ''
+                    GROUP BY {key}, f_model_version, f_client
+                ),
+                versions AS (
+                    SELECT {key}, f_model_version, {rank} AS rank,
+                        groupBitmapMergeState(f_slots) AS slots
+                    FROM {table_name}
+                    WHERE {key_filter} AND f_client != ''
+                    GROUP BY {key}, f_model_version
+                ),
+                covered AS (
+                    SELECT a.{key} AS {key}, a.f_model_version AS f_model_version,
+                        groupBitmapMergeStateIf(
+                            b.slots, (b.rank, b.f_model_version) < (a.rank, a.f_model_version)
+                        ) AS slots
+                    FROM versions AS a
+                    INNER JOIN versions AS b ON a.{key} = b.{key}
+                    GROUP BY a.{key}, a.f_model_version
+                )
+            SELECT {key}, f_client, sum(bitmapCardinality(counted)) AS blocks,
+                minIf(bitmapMin(counted), bitmapCardinality(counted) > 0),
+                max(bitmapMax(counted))
+            FROM (
+                SELECT clients.{key} AS {key}, clients.f_client AS f_client,
+                    bitmapAndnot(clients.slots, covered.slots) AS counted
+                FROM clients
+                INNER JOIN covered
+                ON clients.{key} = covered.{key}
+                AND clients.f_model_version = covered.f_model_version
+            )
+            GROUP BY {key}, f_client
+            HAVING blocks > 0"""
+
+    def get_proposer_clients(self, proposer_indices, model_version=None):
+        """
+        {proposer_index: [{"client", "blocks", "first_slot", "last_slot"}]}
+        with the blocks of each proposer guessed as each client by
+        `model_version` (by default the active model), or by other models
+        for the slots it hasn't classified, most blocks first.
+        """
+        parameters = {"proposer_indices": list(proposer_indices)}
+        version = model_version_expression(model_version, parameters)
+        blocks = self._aggregate_client_blocks(
+            "proposer",
+            "f_proposer_index IN {proposer_indices:Array(UInt64)}",
+            version,
+        )
+        query_res = self.client.query(
+            f"""{blocks}
+                ORDER BY f_proposer_index, blocks DESC, f_client""",
+            parameters=parameters,
+        )
+        proposers = {}
+        for (
+            proposer_index,
+            client,
+            blocks,
+            first_slot,
+            last_slot,
+        ) in query_res.result_rows:
+            proposers.setdefault(proposer_index, []).append(
+                {
+                    "client": client,
+                    "blocks": blocks,
+                    "first_slot": first_slot,
+                    "last_slot": last_slot,
+                }
+            )
+        return proposers
+
+    def get_client_shares(self, start_slot, end_slot, period="day", model_version=None):
+        """
+        [{period, "client", "blocks", "share"}] for every day or epoch
+        overlapping start_slot..end_slot, `share` being the fraction of the
+        period's blocks guessed as the client by `model_version` (by default
+        the active model), or by other models for the slots it hasn't
+        classified. Periods at both ends are counted in full.
+        """
+        _, key, _ = AGGREGATE_TABLES[period]
+        parameters = {"start_slot": start_slot, "end_slot": end_slot}
+        version = model_version_expression(model_version, parameters)
+        blocks = self._aggregate_client_blocks(
+            period,
+            f"""{key} BETWEEN {aggregate_key(period, "{start_slot:UInt64}")}
+                AND {aggregate_key(period, "{end_slot:UInt64}")}""",
+            version,
+        )
+        query_res = self.client.query(
+            f"""SELECT {key}, f_client, blocks, blocks / sum(blocks) OVER (PARTITION BY {key})
+                FROM ({blocks})
+                ORDER BY {key}, blocks DESC, f_client""",
+            parameters=parameters,
+        )
+        return [
+            {
+                # Days as YYYY-MM-DD
+                period: str(value) if period == "day" else value,
+                "client": client,
+                "blocks": blocks,
+                "share": share,
+            }
+            for value, client, blocks, share in query_res.result_rows
+        ]
+
+    def get_max_feature_slot(self):
+        query_res = self.client.query(f"SELECT MAX(f_slot) FROM {FEATURES_TABLE_NAME}")
+        return query_res.first_row[0]
+
+    def get_slot_features(self, start_slot, end_slot):
+        # (slot, proposer_index, graffiti_guess, {feature: value}) in slot order
+        query_res = self.client.query(
+            f"""SELECT {", ".join(FEATURE_COLUMN_NAMES)} FROM {FEATURES_TABLE_NAME} FINAL
+                WHERE f_slot BETWEEN {{start_slot:UInt64}} AND {{end_slot:UInt64}}
+                ORDER BY f_slot""",
+            parameters={"start_slot": start_slot, "end_slot": end_slot},
+        )
+        return query_res.result_rows
+
+    def compare_model_versions(self, model_version, other_model_version):
+        """
+        Number of slots classified by both model versions, for every pair of
+        (best guess of model_version, best guess of other_model_version).
+        """
+        query_res = self.client.query(
+            f"""SELECT a.f_best_guess_single, b.f_best_guess_single, count()
+                FROM (
+                    SELECT f_slot, f_best_guess_single FROM {TABLE_NAME} FINAL
+                    WHERE f_model_version = {{model_version:String}} AND f_best_guess_single != ''
+                ) AS a
+                INNER JOIN (
+                    SELECT f_slot, f_best_guess_single FROM {TABLE_NAME} FINAL
+                    WHERE f_model_version = {{other_model_version:String}} AND f_best_guess_single != ''
+                ) AS b USING (f_slot)
+                GROUP BY a.f_best_guess_single, b.f_best_guess_single
+                ORDER BY count() DESC""",
+            parameters={
+                "model_version": model_version,
+                "other_model_version": other_model_version,
+            },
+        )
+        return query_res.result_rows
+
+    def insert_settings(self):
+        if not self.async_insert:
+            return None
+        # Let the server batch the parts, but only return once they are flushed
+        return {"async_insert": 1, "wait_for_async_insert": 1}
+
+    def insert_client_guess_columns(self, columns):
+        """
+        Insert guesses given as a dict mapping each name in COLUMN_NAMES to a
+        column (NumPy array or sequence), all of the same length.
+        """
         self.client.insert(
             TABLE_NAME,
-            guesses,
+            [columns[name] for name in COLUMN_NAMES],
+            column_names=COLUMN_NAMES,
+            column_oriented=True,
+            settings=self.insert_settings(),
         )
 
+    def insert_client_guesses(self, guesses, model_version=""):
+        self.insert_client_guess_columns(convert_to_columns(guesses, model_version))
+
+    def insert_slot_feature_columns(self, columns):
+        self.client.insert(
+            FEATURES_TABLE_NAME,
+            [columns[name] for name in FEATURE_COLUMN_NAMES],
+            column_names=FEATURE_COLUMN_NAMES,
+            column_oriented=True,
+            settings=self.insert_settings(),
+        )
+
+
+class BackgroundInserter:
+    """
+    Runs inserts on a dedicated thread and connection. `submit` only blocks
+    once `max_pending` batches are waiting. The features of a batch, if
+    given, are inserted before its guesses. The first failed insert stops the
+    thread from inserting anything else and is re-raised by the next
+    `submit` or `flush`.
+    """
+
+    def __init__(self, db, max_pending=DEFAULT_MAX_PENDING_INSERTS):
+        self.db = db
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self.error is not None:
+                    # Keep draining so producers never block on a dead consumer
+                    continue
+                metrics.QUEUE_DEPTH.labels("insert").set(self.queue.qsize())
+                columns, callback, feature_columns = item
+                try:
+                    start = time.time()
+                    with metrics.STAGE_SECONDS.labels("insert").time():
+                        if feature_columns is not None:
+                            self.db.insert_slot_feature_columns(feature_columns)
+                        self.db.insert_client_guess_columns(columns)
+                    end = time.time()
+                    logging.info(
+                        "Inserted {} rows in {} seconds".format(
+                            len(columns["f_slot"]), end - start
+                        )
+                    )
+                    if callback is not None:
+                        callback()
+                except Exception as e:
+                    logging.error(f"Error inserting guesses: {e}")
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, columns, callback=None, feature_columns=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((columns, callback, feature_columns))
+        metrics.QUEUE_DEPTH.labels("insert").set(self.queue.qsize())
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
 
 def convert_to_clickhouse_format(guesses):
     return [
@@ -43,3 +649,55 @@ def convert_to_clickhouse_format(guesses):
         )
         for guess in guesses
     ]
+
+
+def convert_to_guess(row, clients):
+    probability_map = "{}"
+    if row["f_best_guess_single"] != "":
+        # Float32 columns, rounded to drop the float64 conversion noise
+        probability_map = {
+            client: round(float(row[PROBABILITY_COLUMNS[client]]), 6)
+            for client in clients
+        }
+    return {
+        "slot": row["f_slot"],
+        "best_guess_single": row["f_best_guess_single"],
+        "best_guess_multi": row["f_best_guess_multi"],
+        "probability_map": probability_map,
+        "proposer_index": row["f_proposer_index"],
+    }
+
+
+def convert_to_columns(guesses, model_version=""):
+    # Rows as returned by getSlotGuesses(..., db_format=True)
+    if len(guesses) == 0:
+        return {name: [] for name in COLUMN_NAMES}
+    slots, best_guesses_single, best_guesses_multi, probability_maps, proposers = zip(
+        *guesses
+    )
+    columns = {
+        "f_slot": np.array(slots, dtype=np.uint64),
+        "f_model_version": [model_version] * len(slots),
+        "f_best_guess_single": list(best_guesses_single),
+        "f_best_guess_multi": list(best_guesses_multi),
+        "f_proposer_index": np.array(proposers, dtype=np.uint64),
+    }
+    for client, column in PROBABILITY_COLUMNS.items():
+        columns[column] = np.array(
+            [probability_map.get(client, 0.0) for probability_map in probability_maps],
+            dtype=np.float32,
+        )
+    return columns
+
+
+def convert_to_feature_columns(slot_features):
+    # Rows as returned by extract_slot_features
+    if len(slot_features) == 0:
+        return {name: [] for name in FEATURE_COLUMN_NAMES}
+    slots, proposers, graffiti_guesses, features = zip(*slot_features)
+    return {
+        "f_slot": np.array(slots, dtype=np.uint64),
+        "f_proposer_index": np.array(proposers, dtype=np.uint64),
+        "f_graffiti_guess": list(graffiti_guesses),
+        "f_features": list(features),
+    }
@@ -0,0 +1,290 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "lock"
+# One file per column, rows are appended in the order slots were downloaded
+COLUMNS = {
+    "slot": np.uint64,
+    "has_block": np.uint8,
+    "proposer_index": np.uint64,
+    # Index into the graffiti values of the manifest, 0 is no graffiti guess
+    "graffiti": np.uint16,
+    "features": np.float64,
+}
+
+
+class FeatureStoreError(Exception):
+    pass
+
+
+def _column_path(path, name):
+    return os.path.join(path, f"{name}.bin")
+
+
+class FeatureStore:
+    """
+    On-disk, append-only and columnar store of what was downloaded for each
+    slot: whether it had a block, its proposer index, its graffiti guess and
+    the values of `feature_names`. Columns are memory-mapped and looked up by
+    slot, so slots stored once are classified again without the beacon node.
+
+    Several processes can share a store: appends are serialized by a lock
+    file, and rows only become visible once the manifest counting them is
+    replaced, so readers never see a partial append.
+    """
+
+    def __init__(self, path, feature_names=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.manifest_stat = None
+        self.rows = 0
+        self.columns = {}
+        self.sorted_slots = np.empty(0, dtype=np.uint64)
+        # Row of each entry of sorted_slots, None while rows are in slot order
+        self.order = None
+        # Buffers sorted_slots and order are views of once rows are out of
+        # order, with room to grow so that appends after the last slot only
+        # copy the new rows
+        self.sorted_slots_buffer = None
+        self.order_buffer = None
+        if not os.path.exists(os.path.join(path, MANIFEST_NAME)):
+            if feature_names is None:
+                raise FeatureStoreError(f"No feature store at {path}")
+            os.makedirs(path, exist_ok=True)
+            self._write_manifest(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "features": list(feature_names),
+                    "graffiti": [""],
+                    "rows": 0,
+                }
+            )
+            logging.info(f"Created feature store at {path}")
+        self.refresh()
+        self.feature_names = self.manifest["features"]
+
+    def _write_manifest(self, manifest):
+        tmp_path = os.path.join(self.path, f"{MANIFEST_NAME}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_NAME))
+
+    def _map_column(self, name, rows):
+        dtype = COLUMNS[name]
+        if name == "features":
+            shape = (rows, len(self.manifest["features"]))
+        else:
+            shape = (rows,)
+        if rows == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(_column_path(self.path, name), dtype, mode="r", shape=shape)
+
+    def refresh(self):
+        # Picks up the rows appended by other processes since the last call
+        with self.lock:
+            manifest_path = os.path.join(self.path, MANIFEST_NAME)
+            stat = os.stat(manifest_path)
+            stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat == self.manifest_stat:
+                return
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("format_version") != FORMAT_VERSION:
+                raise FeatureStoreError(
+                    f"Feature store format {manifest.get('format_version')} is not supported, expected {FORMAT_VERSION}"
+                )
+            self.manifest = manifest
+            self.manifest_stat = stat
+            if self.columns and manifest["rows"] == self.rows:
+                return
+            previous_rows = self.rows
+            self.rows = manifest["rows"]
+            self.columns = {name: self._map_column(name, self.rows) for name in COLUMNS}
+            self._index_rows(previous_rows)
+
+    def _set_index(self, sorted_slots, order, capacity):
+        self.sorted_slots_buffer = np.empty(capacity, dtype=np.uint64)
+        self.order_buffer = np.empty(capacity, dtype=np.int64)
+        self.sorted_slots_buffer[: len(order)] = sorted_slots
+        self.order_buffer[: len(order)] = order
+        self.sorted_slots = self.sorted_slots_buffer[: len(order)]
+        self.order = self.order_buffer[: len(order)]
+
+    def _index_rows(self, previous_rows):
+        slots = self.columns["slot"]
+        new_slots = slots[previous_rows:]
+        after_last = bool(np.all(new_slots[1:] > new_slots[:-1])) and (
+            previous_rows == 0 or new_slots[0] > self.sorted_slots[-1]
+        )
+        if self.order is None and after_last:
+            # The usual case: rows were appended in slot order
+            self.sorted_slots = slots
+            return
+        if self.order is None:
+            self._set_index(
+                slots[:previous_rows],
+                np.arange(previous_rows, dtype=np.int64),
+                2 * self.rows,
+            )
+        if after_last:
+            # Only the new rows are copied, into the room left in the buffers
+            if self.rows > len(self.order_buffer):
+                self._set_index(self.sorted_slots, self.order, 2 * self.rows)
+            self.sorted_slots_buffer[previous_rows : self.rows] = new_slots
+            self.order_buffer[previous_rows : self.rows] = np.arange(
+                previous_rows, self.rows
+            )
+            self.sorted_slots = self.sorted_slots_buffer[: self.rows]
+            self.order = self.order_buffer[: self.rows]
+            return
+        # Merge the new rows into the sorted index
+        new_order = previous_rows + np.argsort(new_slots, kind="stable")
+        positions = np.searchsorted(self.sorted_slots, slots[new_order])
+        order = np.insert(self.order, positions, new_order)
+        self._set_index(slots[order], order, 2 * self.rows)
+
+    def _find(self, start_slot, end_slot):
+        # Rows of the stored slots in start_slot..end_slot, in slot order.
+        # Python ints would convert the whole uint64 index for every search
+        if end_slot < start_slot or end_slot < 0:
+            return np.arange(0)
+        first = np.searchsorted(
+            self.sorted_slots, np.uint64(max(start_slot, 0)), side="left"
+        )
+        last = np.searchsorted(self.sorted_slots, np.uint64(end_slot), side="right")
+        if self.order is None:
+            return np.arange(first, last)
+        return self.order[first:last]
+
+    def has_features(self, feature_names):
+        return set(feature_names) <= set(self.feature_names)
+
+    def has_range(self, start_slot, end_slot):
+        # Whether every slot of the range was stored, with or without a block
+        self.refresh()
+        with self.lock:
+            return len(self._find(start_slot, end_slot)) == end_slot - start_slot + 1
+
+    def stored_slots(self, start_slot, end_slot):
+        self.refresh()
+        with self.lock:
+            return set(self.columns["slot"][self._find(start_slot, end_slot)].tolist())
+
+    def get_max_slot(self):
+        self.refresh()
+        with self.lock:
+            if len(self.sorted_slots) == 0:
+                return None
+            return int(self.sorted_slots[-1])
+
+    def get_slot_features(self, start_slot, end_slot, feature_names=None):
+        """
+        (slot, proposer_index, graffiti_guess, {feature: value}) for every
+        stored block of start_slot..end_slot in slot order, the same rows as
+        extract_slot_features and ClickHouseDB.get_slot_features.
+        """
+        self.refresh()
+        if feature_names is None:
+            feature_names = self.feature_names
+        feature_indices = [self.feature_names.index(name) for name in feature_names]
+        with self.lock:
+            rows = self._find(start_slot, end_slot)
+            rows = rows[self.columns["has_block"][rows] == 1]
+            slots = self.columns["slot"][rows].tolist()
+            proposer_indices = self.columns["proposer_index"][rows].tolist()
+            graffiti_values = self.manifest["graffiti"]
+            graffiti = [graffiti_values[i] for i in self.columns["graffiti"][rows]]
+            features = self.columns["features"][rows][:, feature_indices].tolist()
+        return [
+            (slot, proposer_index, graffiti_guess, dict(zip(feature_names, values)))
+            for slot, proposer_index, graffiti_guess, values in zip(
+                slots, proposer_indices, graffiti, features
+            )
+        ]
+
+    def append_range(self, start_slot, end_slot, slot_features):
+        """
+        Store the slots start_slot..end_slot, `slot_features` holding the
+        rows of extract_slot_features for their blocks; the other slots are
+        stored as empty. Slots already in the store are left as they are.
+        """
+        blocks = {row[0]: row for row in slot_features}
+        with open(os.path.join(self.path, LOCK_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            with self.lock:
+                stored = set(
+                    self.columns["slot"][self._find(start_slot, end_slot)].tolist()
+                )
+                slots = [
+                    slot
+                    for slot in range(start_slot, end_slot + 1)
+                    if slot not in stored
+                ]
+                if len(slots) == 0:
+                    return 0
+                manifest = dict(self.manifest)
+                graffiti_values = list(manifest["graffiti"])
+                graffiti_codes = {value: i for i, value in enumerate(graffiti_values)}
+                feature_count = len(self.feature_names)
+                columns = {name: [] for name in COLUMNS}
+                for slot in slots:
+                    row = blocks.get(slot)
+                    columns["slot"].append(slot)
+                    if row is None:
+                        columns["has_block"].append(0)
+                        columns["proposer_index"].append(0)
+                        columns["graffiti"].append(0)
+                        columns["features"].append([np.nan] * feature_count)
+                        continue
+                    _, proposer_index, graffiti_guess, features = row
+                    graffiti_guess = graffiti_guess or ""
+                    if graffiti_guess not in graffiti_codes:
+                        graffiti_codes[graffiti_guess] = len(graffiti_values)
+                        graffiti_values.append(graffiti_guess)
+                    columns["has_block"].append(1)
+                    columns["proposer_index"].append(proposer_index)
+                    columns["graffiti"].append(graffiti_codes[graffiti_guess])
+                    columns["features"].append(
+                        [features[name] for name in self.feature_names]
+                    )
+                for name, dtype in COLUMNS.items():
+                    data = np.asarray(columns[name], dtype=dtype)
+                    with open(_column_path(self.path, name), "ab") as f:
+                        # Drops what an interrupted append left after the last
+                        # row of the manifest
+                        f.truncate(self.rows * data.nbytes // len(slots))
+                        f.write(data.tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+                manifest["graffiti"] = graffiti_values
+                manifest["rows"] = self.rows + len(slots)
+                self._write_manifest(manifest)
+            self.refresh()
+        return len(slots)
+
+
+def open_feature_store(path, classifier):
+    # A new store keeps every feature a retrained model may use
+    from blockprint.classifier import VIABLE_FEATURES
+
+    feature_store = FeatureStore(
+        path, sorted(set(VIABLE_FEATURES) | set(classifier.features))
+    )
+    if not feature_store.has_features(classifier.features):
+        missing_features = sorted(
+            set(classifier.features) - set(feature_store.feature_names)
+        )
+        raise FeatureStoreError(
+            f"Features {missing_features} of the model are not in the feature store at {path}, use another path"
+        )
+    return feature_store
@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 
+from startup import StartupProfiler, add_profile_startup_argument
 import argparse
+import concurrent.futures
 import logging
 import os
+import threading
 import time
-from blockprint.classifier import Classifier
-import blockprint.load_blocks as lb
-import blockprint.prepare_training_data as pt
+import numpy as np
 import requests
+from beacon import get_beacon_client
+import metrics
+from snapshot import graffiti_only_guess
+
+# blockprint (and scikit-learn with it) is imported by the functions using it,
+# so that --help and the modules importing this one start quickly
 
 DEFAULT_MODEL_FOLDER = "blockprint/model/"
 DEFAULT_NODE_URL = "http://localhost:5052"
 MAX_SLOTS = 10000
+DEFAULT_CLASSIFY_BATCH_SIZE = 2048
+DEFAULT_STREAM_CHUNK_SIZE = 512
+
+# Serializes writes to the model folder between threads serving requests
+model_folder_lock = threading.Lock()
+# ClassifierPool the large batches are classified with, see set_classify_pool
+classify_pool = None
 
 
 class GuessRequesterError(Exception):
@@ -51,49 +65,220 @@ def parse_args():
         "--node-url",
         default=DEFAULT_NODE_URL,
         type=str,
-        help="URL of the beacon node to download blocks from (default: http://localhost:5052)",
+        help="URL of the beacon node to download blocks from. Several comma-separated URLs can be given, requests then go to the fastest available one (default: http://localhost:5052)",
+    )
+    parser.add_argument(
+        "--feature-store",
+        type=str,
+        help="Path to a feature store. Slots it has are classified from it without the beacon node, finalized slots downloaded from the node are added to it. It is created if it doesn't exist",
     )
+    add_profile_startup_argument(parser)
     return parser.parse_args()
 
 
+def get_finalized_slot(node_url=DEFAULT_NODE_URL):
+    return get_beacon_client(node_url).header_slot("finalized")
+
+
 def add_to_model_if_possible(model_folder, block_reward):
-    client = pt.classify_reward_by_graffiti(block_reward[0])
+    import blockprint.load_blocks as lb
+    import blockprint.prepare_training_data as pt
+
+    client = pt.classify_reward_by_graffiti(block_reward)
     if client is None:
         logging.info(
             "Client couldn't be determined with graffity so can not be added to the model"
         )
-        return
-    lb.store_block_rewards(block_reward[0], client, model_folder)
+        return None
+    with model_folder_lock:
+        lb.store_block_rewards(block_reward, client, model_folder)
     logging.info(f"Added to model")
+    return client
 
 
-def parse_probability_map(probability_map, threshold=0.2):
-    formatted = []
-    if probability_map == "{}":
-        return formatted
-    for key, value in probability_map.items():
-        if value >= threshold:
-            formatted.append(f"{key}:{int(value*100)}")
-    return formatted
+def set_classify_pool(pool):
+    # Used by classify_block_rewards in this process, None to stop using it
+    global classify_pool
+    classify_pool = pool
 
 
-def getSlotGuesses(
-    start_slot,
-    end_slot,
-    classifier,
-    model_folder=DEFAULT_MODEL_FOLDER,
-    node_url=DEFAULT_NODE_URL,
-    add_to_model=False,
-    db_format=False,
+def classify_block_rewards(
+    classifier, block_rewards, batch_size=DEFAULT_CLASSIFY_BATCH_SIZE
 ):
-    if end_slot - start_slot > MAX_SLOTS:
-        end_slot = start_slot + MAX_SLOTS
+    """
+    Classify many block rewards at once, returning one guess per reward in the
+    same shape as `Classifier.classify`. Features are stacked into a single
+    matrix and the model is queried once per `batch_size` rows. With a
+    classify pool, large enough batches of a snapshot classifier are spread
+    over its worker processes instead.
+    """
+    if classify_pool is not None and classify_pool.can_classify(
+        classifier, len(block_rewards)
+    ):
+        guesses = classify_pool.classify(classifier, block_rewards)
+        if guesses is not None:
+            return guesses
+
+    from blockprint.classifier import into_feature_row
+    import blockprint.prepare_training_data as pt
+
+    model = getattr(classifier, "classifier", None)
+    features = getattr(classifier, "features", None)
+    enabled_clients = getattr(classifier, "enabled_clients", None)
+    if model is None or features is None or enabled_clients is None:
+        # Classifiers without an exposed sklearn model (e.g. MultiClassifier)
+        with metrics.STAGE_SECONDS.labels("predict").time():
+            return [classifier.classify(block_reward) for block_reward in block_rewards]
+
+    graffiti_only_clients = getattr(classifier, "graffiti_only_clients", set())
+    guesses = [None] * len(block_rewards)
+    graffiti_guesses = []
+    rows = []
+    row_indices = []
+    with metrics.STAGE_SECONDS.labels("extract_features").time():
+        for i, block_reward in enumerate(block_rewards):
+            graffiti_guess = pt.classify_reward_by_graffiti(block_reward)
+            if graffiti_guess in graffiti_only_clients:
+                # Keep the graffiti-only override logic inside the classifier
+                guesses[i] = classifier.classify(block_reward)
+                continue
+            rows.append(into_feature_row(block_reward, features))
+            graffiti_guesses.append(graffiti_guess)
+            row_indices.append(i)
+
+    for i, guess in zip(
+        row_indices,
+        classify_feature_rows(classifier, rows, graffiti_guesses, batch_size),
+    ):
+        guesses[i] = guess
+    return guesses
+
+
+def classify_feature_rows(
+    classifier, rows, graffiti_guesses, batch_size=DEFAULT_CLASSIFY_BATCH_SIZE
+):
+    # Rows of classifier.features values, as built by into_feature_row
+    from blockprint.classifier import (
+        compute_best_guess,
+        compute_guess_list,
+        compute_multilabel,
+    )
+
+    enabled_clients = classifier.enabled_clients
     guesses = []
-    # Load the blocks
+    for batch_start in range(0, len(rows), batch_size):
+        feature_matrix = np.asarray(
+            rows[batch_start : batch_start + batch_size], dtype=np.float64
+        )
+        with metrics.STAGE_SECONDS.labels("predict").time():
+            probabilities = classifier.classifier.predict_proba(feature_matrix).tolist()
+        for row_probabilities, graffiti_guess in zip(
+            probabilities, graffiti_guesses[batch_start : batch_start + batch_size]
+        ):
+            prob_by_client = dict(zip(enabled_clients, row_probabilities))
+            guesses.append(
+                (
+                    compute_best_guess(prob_by_client),
+                    compute_multilabel(
+                        compute_guess_list(prob_by_client, enabled_clients)
+                    ),
+                    prob_by_client,
+                    graffiti_guess,
+                )
+            )
+    return guesses
+
+
+def can_classify_features(classifier):
+    # Classifiers without an exposed sklearn model need the block rewards
+    return all(
+        getattr(classifier, name, None) is not None
+        for name in ("classifier", "features", "enabled_clients")
+    )
+
+
+def classify_slot_features(classifier, slot_features):
+    """
+    Guesses in the format of buildSlotGuesses(..., db_format=True) for rows
+    of extract_slot_features, as read back from ClickHouseDB.get_slot_features
+    or a FeatureStore.
+    """
+    if len(slot_features) == 0:
+        return []
+    missing_features = set(classifier.features) - set(slot_features[0][3])
+    if len(missing_features) > 0:
+        raise ValueError(
+            f"Features {sorted(missing_features)} are not stored, reindex the slots with load_db.py --reindex instead"
+        )
+
+    graffiti_only_clients = getattr(classifier, "graffiti_only_clients", set())
+    guesses = [None] * len(slot_features)
+    rows = []
+    graffiti_guesses = []
+    row_indices = []
+    for i, (_, _, graffiti_guess, features) in enumerate(slot_features):
+        if graffiti_guess in graffiti_only_clients:
+            guesses[i] = graffiti_only_guess(classifier.enabled_clients, graffiti_guess)
+            continue
+        rows.append([features[name] for name in classifier.features])
+        graffiti_guesses.append(graffiti_guess or None)
+        row_indices.append(i)
+    if len(rows) > 0:
+        for i, guess in zip(
+            row_indices, classify_feature_rows(classifier, rows, graffiti_guesses)
+        ):
+            guesses[i] = guess
+
+    return [
+        (slot, best_guess_single, best_guess_multi, probability_map, proposer_index)
+        for (slot, proposer_index, _, _), (
+            best_guess_single,
+            best_guess_multi,
+            probability_map,
+            _,
+        ) in zip(slot_features, guesses)
+    ]
+
+
+def extract_slot_features(block_rewards, feature_names):
+    """
+    (slot, proposer_index, graffiti_guess, {feature: value}) for every block
+    reward, to store the features of a slot next to its guess.
+    """
+    from blockprint.classifier import into_feature_row
+    import blockprint.prepare_training_data as pt
+
+    with metrics.STAGE_SECONDS.labels("extract_features").time():
+        return [
+            (
+                int(block_reward["meta"]["slot"]),
+                int(block_reward["meta"]["proposer_index"]),
+                pt.classify_reward_by_graffiti(block_reward) or "",
+                dict(zip(feature_names, into_feature_row(block_reward, feature_names))),
+            )
+            for block_reward in block_rewards
+        ]
+
+
+def download_block_rewards(
+    start_slot, end_slot, node_url=DEFAULT_NODE_URL, beacon_client=None
+):
+    # Same endpoint as lb.download_block_rewards, over pooled and retried connections
+    if beacon_client is None:
+        beacon_client = get_beacon_client(node_url)
+    return beacon_client.block_rewards(start_slot, end_slot)
+
+
+def downloadSlotBlockRewards(
+    start_slot, end_slot, node_url=DEFAULT_NODE_URL, beacon_client=None
+):
     logging.info(f"Downloading blocks {start_slot} to {end_slot}...")
     start_time = time.time()
     try:
-        block_rewards = lb.download_block_rewards(start_slot, end_slot, node_url)
+        with metrics.STAGE_SECONDS.labels("download").time():
+            block_rewards = download_block_rewards(
+                start_slot, end_slot, node_url, beacon_client
+            )
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 400:
             message = e.response.json()["message"]
@@ -108,9 +293,123 @@ def getSlotGuesses(
         logging.error(f"Error downloading blocks: {e}")
         raise e  # Re-raise the exception for other status codes
     end_time = time.time()
+    metrics.observe_slots(start_slot, end_slot, len(block_rewards))
     logging.info(
         f"Downloaded {len(block_rewards)} blocks in {round(end_time - start_time, 2)} seconds. Found {end_slot - start_slot - len(block_rewards)+1} missing blocks."
     )
+    return block_rewards
+
+
+def add_to_feature_store(
+    feature_store, start_slot, end_slot, block_rewards, store_up_to_slot=None
+):
+    # Slots after store_up_to_slot may still be reorged, so they aren't stored
+    if store_up_to_slot is not None:
+        end_slot = min(end_slot, store_up_to_slot)
+    if end_slot < start_slot or feature_store.has_range(start_slot, end_slot):
+        return
+    block_rewards = [
+        block_reward
+        for block_reward in block_rewards
+        if int(block_reward["meta"]["slot"]) <= end_slot
+    ]
+    feature_store.append_range(
+        start_slot,
+        end_slot,
+        extract_slot_features(block_rewards, feature_store.feature_names),
+    )
+
+
+def fetchSlotChunk(
+    start_slot,
+    end_slot,
+    node_url=DEFAULT_NODE_URL,
+    feature_store=None,
+    feature_names=None,
+    store_up_to_slot=None,
+):
+    """
+    (block_rewards, slot_features) of a chunk. When `feature_store` has every
+    slot of the chunk, the `feature_names` of its blocks are read from it and
+    block_rewards is None. Otherwise the chunk is downloaded, added to the
+    store and slot_features is None. Without `feature_names` the store is
+    only added to.
+    """
+    if (
+        feature_store is not None
+        and feature_names is not None
+        and feature_store.has_range(start_slot, end_slot)
+    ):
+        return None, feature_store.get_slot_features(
+            start_slot, end_slot, feature_names
+        )
+    block_rewards = downloadSlotBlockRewards(start_slot, end_slot, node_url)
+    if feature_store is not None and block_rewards is not None:
+        add_to_feature_store(
+            feature_store, start_slot, end_slot, block_rewards, store_up_to_slot
+        )
+    return block_rewards, None
+
+
+def buildSlotGuessesFromFeatures(
+    start_slot, end_slot, slot_features, classifier, db_format=False
+):
+    # Same as buildSlotGuesses, for the blocks of a FeatureStore
+    start_time = time.time()
+    block_guesses = classify_slot_features(classifier, slot_features)
+    end_time = time.time()
+    logging.info(
+        f"Classified {len(slot_features)} stored blocks in {round(end_time - start_time, 2)} seconds."
+    )
+    guesses_by_slot = {guess[0]: guess for guess in block_guesses}
+    guesses = []
+    for slot_num in range(start_slot, end_slot + 1):
+        (
+            _,
+            best_guess_single,
+            best_guess_multi,
+            probability_map,
+            proposer_index,
+        ) = guesses_by_slot.get(slot_num, (slot_num, "", "", {}, 0))
+        if db_format:
+            guesses.append(
+                (
+                    slot_num,
+                    best_guess_single,
+                    best_guess_multi,
+                    probability_map,
+                    proposer_index,
+                )
+            )
+        else:
+            guesses.append(
+                {
+                    "slot": slot_num,
+                    "best_guess_single": best_guess_single,
+                    "best_guess_multi": best_guess_multi,
+                    "probability_map": probability_map or "{}",
+                    "proposer_index": proposer_index,
+                }
+            )
+    return guesses
+
+
+def buildSlotGuesses(
+    start_slot,
+    end_slot,
+    block_rewards,
+    classifier,
+    model_folder=DEFAULT_MODEL_FOLDER,
+    add_to_model=False,
+    db_format=False,
+):
+    guesses = []
+    start_time = time.time()
+    block_guesses = classify_block_rewards(classifier, block_rewards)
+    end_time = time.time()
+    logging.info(
+        f"Classified {len(block_rewards)} blocks in {round(end_time - start_time, 2)} seconds."
+    )
 
     block_rewards_index = 0
     for i in range(end_slot - start_slot + 1):
@@ -123,18 +422,18 @@ def getSlotGuesses(
         if len(block_rewards) > 0 and block_rewards_index < len(block_rewards):
             slot = block_rewards[block_rewards_index]
             if i == int(slot["meta"]["slot"]) - start_slot:
+                guess = block_guesses[block_rewards_index]
                 block_rewards_index += 1
                 if add_to_model:
                     logging.info(f"Adding block {slot_num} to model...")
-                    add_to_model_if_possible(model_folder, slot_num)
-                guess = classifier.classify(slot)
+                    add_to_model_if_possible(model_folder, slot)
                 if guess is None:
-                    guesses = None
-                    return
+                    return None
                 best_guess_single, best_guess_multi, probability_map, _ = guess
                 proposer_index = int(slot["meta"]["proposer_index"])
         if db_format:
-            probability_map = parse_probability_map(probability_map)
+            if probability_map == "{}":
+                probability_map = {}
             guesses.append(
                 (
                     slot_num,
@@ -157,6 +456,122 @@ def getSlotGuesses(
     return guesses
 
 
+def split_slot_range(start_slot, end_slot, chunk_size):
+    return [
+        (chunk_start, min(chunk_start + chunk_size - 1, end_slot))
+        for chunk_start in range(start_slot, end_slot + 1, chunk_size)
+    ]
+
+
+def iterSlotGuessChunks(
+    start_slot,
+    end_slot,
+    classifier,
+    model_folder=DEFAULT_MODEL_FOLDER,
+    node_url=DEFAULT_NODE_URL,
+    add_to_model=False,
+    db_format=False,
+    chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+    feature_store=None,
+    store_up_to_slot=None,
+):
+    """
+    Yield the guesses for start_slot..end_slot as one list per chunk of
+    `chunk_size` slots. The next chunk is downloaded while the current one is
+    classified and consumed, so at most two chunks are held in memory.
+    Chunks fully in `feature_store` are classified from it, the downloaded
+    ones are added to it up to `store_up_to_slot`.
+    """
+    chunks = split_slot_range(start_slot, end_slot, chunk_size)
+    if len(chunks) == 0:
+        return
+    # Adding blocks to the model needs their rewards, not only their features
+    read_store = (
+        feature_store is not None
+        and not add_to_model
+        and can_classify_features(classifier)
+    )
+
+    def fetch(chunk):
+        return fetchSlotChunk(
+            *chunk,
+            node_url,
+            feature_store,
+            classifier.features if read_store else None,
+            store_up_to_slot,
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_download = executor.submit(fetch, chunks[0])
+        for i, (chunk_start, chunk_end) in enumerate(chunks):
+            block_rewards, slot_features = next_download.result()
+            if i + 1 < len(chunks):
+                next_download = executor.submit(fetch, chunks[i + 1])
+            if slot_features is not None:
+                yield buildSlotGuessesFromFeatures(
+                    chunk_start, chunk_end, slot_features, classifier, db_format
+                )
+                continue
+            if block_rewards is None:
+                raise GuessRequesterError(
+                    f"Error downloading blocks {chunk_start} to {chunk_end}"
+                )
+            guesses = buildSlotGuesses(
+                chunk_start,
+                chunk_end,
+                block_rewards,
+                classifier,
+                model_folder,
+                add_to_model,
+                db_format,
+            )
+            if guesses is None:
+                raise GuessRequesterError(
+                    f"Error classifying blocks {chunk_start} to {chunk_end}"
+                )
+            yield guesses
+
+
+def iterSlotGuesses(*args, **kwargs):
+    # Same as iterSlotGuessChunks, one guess at a time
+    for guesses in iterSlotGuessChunks(*args, **kwargs):
+        yield from guesses
+
+
+def getSlotGuesses(
+    start_slot,
+    end_slot,
+    classifier,
+    model_folder=DEFAULT_MODEL_FOLDER,
+    node_url=DEFAULT_NODE_URL,
+    add_to_model=False,
+    db_format=False,
+    feature_store=None,
+    store_up_to_slot=None,
+):
+    if end_slot - start_slot > MAX_SLOTS:
+        end_slot = start_slot + MAX_SLOTS
+    try:
+        # A single chunk, so the whole range is downloaded in one request
+        return list(
+            iterSlotGuesses(
+                start_slot,
+                end_slot,
+                classifier,
+                model_folder,
+                node_url,
+                add_to_model,
+                db_format,
+                chunk_size=end_slot - start_slot + 1,
+                feature_store=feature_store,
+                store_up_to_slot=store_up_to_slot,
+            )
+        )
+    except GuessRequesterError as e:
+        logging.error(e.message)
+        return None
+
+
 def getSlotGuess(
     slot,
     classifier,
@@ -167,7 +582,7 @@ def getSlotGuess(
     # Load the block
     logging.info(f"Downloading block {slot}...")
     try:
-        block_reward = lb.download_block_rewards(slot, slot + 1, node_url)
+        block_reward = download_block_rewards(slot, slot + 1, node_url)
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 400:
             logging.error(f"Error downloading block {slot}: {e}")
@@ -184,17 +599,31 @@ def getSlotGuess(
     # Add the block to the model if it has a graffiti and add_to_model arg is set
     if add_to_model:
         logging.info(f"Adding block {slot} to model...")
-        add_to_model_if_possible(model_folder, block_reward)
+        add_to_model_if_possible(model_folder, block_reward[0])
 
     # Return the guess
     return classifier.classify(block_reward[0])
 
 
+def print_guess(guess):
+    slot = guess["slot"]
+    best_guess_single = guess["best_guess_single"]
+    best_guess_multi = guess["best_guess_multi"]
+    probability_map = guess["probability_map"]
+    proposer_index = guess["proposer_index"]
+    logging.info(f"Slot {slot}:")
+    logging.info(f"Best guess (single): {best_guess_single}")
+    logging.info(f"Best guess (multi): {best_guess_multi}")
+    logging.info(f"Probability map: {probability_map}")
+    logging.info(f"Proposer index: {proposer_index}")
+
+
 def main():
     logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
     logging.basicConfig(level=logging.ERROR, format="%(levelname)s - %(message)s")
 
     args = parse_args()
+    profiler = StartupProfiler(args.profile_startup)
     start_slot = args.start_slot
     end_slot = args.end_slot or args.start_slot
 
@@ -210,45 +639,51 @@ def main():
         return None
 
     # Load the model
+    with profiler.phase("import blockprint"):
+        from blockprint.classifier import Classifier
+
     logging.info("Loading Classifier...")
     start = time.time()
-    classifier = Classifier(model_folder)
+    with profiler.phase("model load"):
+        classifier = Classifier(model_folder)
     end = time.time()
     logging.info("Classifier loaded, took %.2f seconds" % (end - start))
+    feature_store = None
+    store_up_to_slot = None
+    if args.feature_store:
+        from feature_store import open_feature_store
 
-    # Make guesses for all slots
+        feature_store = open_feature_store(args.feature_store, classifier)
+        try:
+            store_up_to_slot = get_finalized_slot(node_url)
+        except Exception as e:
+            # Stored slots can still be classified
+            logging.error(
+                f"Error getting finalized slot, nothing is added to the feature store: {e}"
+            )
+            store_up_to_slot = -1
+    profiler.report()
+
+    # Make guesses for all slots, printing them as soon as they are ready
     try:
-        guesses = getSlotGuesses(
+        start = time.perf_counter()
+        for guess in iterSlotGuesses(
             start_slot,
             end_slot,
             classifier,
             model_folder,
             node_url,
             add_to_model=add_to_model,
-        )
+            feature_store=feature_store,
+            store_up_to_slot=store_up_to_slot,
+        ):
+            profiler.first_request(time.perf_counter() - start)
+            print_guess(guess)
     except EndSlotUnkown as e:
         logging.error(e)
         exit(1)
-
-    if guesses is None:
-        logging.error("Error making guesses")
-        return None
-
-    # Print the guesses
-    for guess in guesses:
-        if guess is None:
-            continue
-        slot = guess["slot"]
-        best_guess_single = guess["best_guess_single"]
-        best_guess_multi = guess["best_guess_multi"]
-        probability_map = guess["probability_map"]
-        proposer_index = guess["proposer_index"]
-        logging.info(f"Slot {slot}:")
-        logging.info(f"Best guess (single): {best_guess_single}")
-        logging.info(f"Best guess (multi): {best_guess_multi}")
-        logging.info(f"Probability map: {probability_map}")
-        logging.info(f"Proposer index: {proposer_index}")
-    return guesses
+    except GuessRequesterError as e:
+        logging.error(f"Error making guesses: {e.message}")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,36 @@
+from startup import StartupProfiler, add_profile_startup_argument
 import argparse
+import json
 import logging
 import os
 import pickle
 import time
-from blockprint.classifier import Classifier, persist_classifier, VIABLE_FEATURES
-import requests
-from guess_requester import getSlotGuesses, EndSlotUnkown
-from clickhouse import ClickHouseDB
+from beacon import CONNECT_TIMEOUT, BeaconClient, backoff_delay
+from guess_requester import set_classify_pool, split_slot_range
+from clickhouse import ClickHouseDB, COMPRESSIONS, DEFAULT_COMPRESSION
+from backfill import BackfillPipeline, DEFAULT_DOWNLOAD_WORKERS, DEFAULT_QUEUE_SIZE
+from feature_store import open_feature_store
+from metrics import add_metrics_argument, set_indexer_progress, start_metrics_server
+from model_updater import ModelUpdater, add_retrain_arguments
+from classify_pool import ClassifierPool, add_classify_workers_argument
+from snapshot import load_snapshot, save_snapshot, snapshot_exists
+from slot_cache import model_fingerprint
 
 DEFAULT_MODEL_FOLDER = "model"
 DEFAULT_NODE_URL = "http://localhost:5052"
-DEFAULT_BACKFILLING_BATCH_SIZE = 10000
+DEFAULT_BACKFILLING_BATCH_SIZE = 1000
+PERSISTED_CLASSIFIER_FOLDER = "persisted_classifier"
+MODES = ["auto", "backfill", "live", "gaps"]
+SECONDS_PER_SLOT = 12
+SLOTS_PER_EPOCH = 32
+HEAD_POLL_INTERVAL = 0.5
+EVENT_STREAM_TIMEOUT = 60
+# Every slot up to the checkpoint was found in the table by a gap scan
+INDEXED_CHECKPOINT = "indexed"
+# Last slot rewritten by the reindex of a model version
+REINDEX_CHECKPOINT = "reindex"
+# Reindexing progress is saved every this many batches
+REINDEX_SEGMENT_BATCHES = 100
 
 
 def parse_args():
@@ -24,7 +44,7 @@ def parse_args():
     parser.add_argument(
         "--persist-classifier",
         type=str,
-        help=f"Persist the classifier to disk after training. It will be stored in the persisted_classifier folder with the name given as parameter. This name will also be used to load the classifier if it exists. The name should end with .pkl. Example: --persist-classifier my_classifier.pkl",
+        help=f"Persist the classifier to disk after training. It will be stored as a snapshot in the persisted_classifier folder with the name given as parameter. This name will also be used to load the classifier if it exists. A classifier pickled by older versions as NAME.pkl is converted to a snapshot. Example: --persist-classifier my_classifier",
     )
     parser.add_argument(
         "clickhouse_endpoint",
@@ -41,42 +61,246 @@ def parse_args():
         "--node-url",
         default=DEFAULT_NODE_URL,
         type=str,
-        help="URL of the beacon node to download blocks from (default: http://localhost:5052)",
+        help="URL of the beacon node to download blocks from. Several comma-separated URLs can be given, requests then go to the fastest available one (default: http://localhost:5052)",
     )
 
     parser.add_argument(
         "--reindex",
         action="store_true",
-        help="Reindex the database. WARNING: This will delete all data in the database and reindex all slots from the beacon node. Useful if the model was updated",
+        help="Reindex the database. All slots already in the database are downloaded and classified again with the current model, next to the guesses of the previous models. Useful if the model was updated, although reclassify.py is much faster when the features of the slots are stored. An interrupted reindex resumes where it stopped when it is run again with the same model",
     )
+    parser.add_argument(
+        "--mode",
+        default="auto",
+        choices=MODES,
+        help="backfill: index up to the head slot as fast as possible and exit. live: follow the head of the chain and index every new block as soon as it is imported. auto: backfill and then switch to live. gaps: look for missing slots in the whole table, index them and exit. Every mode first indexes the slots missing since the last gap scan (default: auto)",
+    )
+    parser.add_argument(
+        "--compression",
+        default=DEFAULT_COMPRESSION,
+        choices=COMPRESSIONS,
+        help=f"Compression used for the data sent to and received from Clickhouse (default: {DEFAULT_COMPRESSION})",
+    )
+    parser.add_argument(
+        "--async-insert",
+        default=False,
+        action="store_true",
+        help="Use Clickhouse asynchronous inserts, letting the server buffer and merge the inserted batches",
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BACKFILLING_BATCH_SIZE,
+        type=int,
+        help=f"Number of slots downloaded per request to the beacon node (default: {DEFAULT_BACKFILLING_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--download-workers",
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        type=int,
+        help=f"Number of batches downloaded concurrently from each beacon node while backfilling. With several --node-url, the batches are shared between the nodes and a node that is done with its share takes over batches from the slower ones (default: {DEFAULT_DOWNLOAD_WORKERS})",
+    )
+    parser.add_argument(
+        "--queue-size",
+        default=DEFAULT_QUEUE_SIZE,
+        type=int,
+        help=f"Maximum number of batches held between the download, classify and insert stages, per beacon node for the downloads (default: {DEFAULT_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--no-store-features",
+        default=False,
+        action="store_true",
+        help="Don't store the feature vectors of the indexed blocks. Without them, reclassify.py can't classify these slots with another model",
+    )
+    parser.add_argument(
+        "--feature-store",
+        type=str,
+        help="Path to a feature store. Batches it has are classified from it instead of being downloaded, which makes --reindex and gap repairs work without the beacon node; downloaded batches are added to it. It is created if it doesn't exist",
+    )
+    add_retrain_arguments(parser)
+    add_classify_workers_argument(parser)
+    add_metrics_argument(parser)
+    add_profile_startup_argument(parser)
 
     return parser.parse_args()
 
 
-def get_node_head_slot(node_url):
-    response = requests.get(node_url + "/eth/v2/beacon/blocks/head")
-    head_slot_json = response.json()
-    return int(head_slot_json["data"]["message"]["slot"])
+def get_node_head_slot(beacon_client):
+    return beacon_client.header_slot("head")
 
 
-def loadSlotGuessesDatabase(
-    start_slot, end_slot, classifier, model_folder, node_url, add_to_model, db
-):
-    guesses = getSlotGuesses(
-        start_slot,
-        end_slot,
-        classifier,
-        model_folder,
-        node_url,
-        add_to_model,
-        db_format=True,
+def stream_block_slots(beacon_client):
+    # Server-sent events, one `block` event per imported block
+    with beacon_client.get(
+        "/eth/v1/events",
+        params={"topics": "block"},
+        headers={"Accept": "text/event-stream"},
+        stream=True,
+        timeout=(CONNECT_TIMEOUT, EVENT_STREAM_TIMEOUT),
+        retries=0,
+    ) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data:"):
+                yield int(json.loads(line[len("data:") :])["slot"])
+
+
+def follow_head_slots(beacon_client):
+    while True:
+        try:
+            yield from stream_block_slots(beacon_client)
+        except Exception as e:
+            logging.error(f"Block event stream failed: {e}. Polling head instead...")
+        # Poll the head header for a slot before trying to reopen the stream
+        retry_stream_at = time.time() + SECONDS_PER_SLOT
+        while time.time() < retry_stream_at:
+            try:
+                yield get_node_head_slot(beacon_client)
+            except Exception as e:
+                logging.error(f"Error getting head slot: {e}. Retrying...")
+            time.sleep(HEAD_POLL_INTERVAL)
+
+
+def backfill(pipeline, last_slot_saved):
+    failures = 0
+    while True:
+        try:
+            head_slot = get_node_head_slot(pipeline.beacon_client)
+        except Exception as e:
+            logging.error(f"Error getting head slot: {e}. Retrying...")
+            time.sleep(backoff_delay(failures))
+            failures += 1
+            continue
+        logging.info(f"Head slot: {head_slot}")
+        set_indexer_progress(head_slot, last_slot_saved)
+        if head_slot <= last_slot_saved:
+            return last_slot_saved
+        try:
+            indexed_slot = pipeline.run(last_slot_saved + 1, head_slot)
+            set_indexer_progress(head_slot, indexed_slot)
+        except Exception as e:
+            logging.error(f"Error backfilling slots: {e}. Retrying...")
+            time.sleep(backoff_delay(failures))
+            failures += 1
+            continue
+        failures = 0
+        if indexed_slot == last_slot_saved:
+            # The head block isn't available for analysis yet, close enough
+            return last_slot_saved
+        last_slot_saved = indexed_slot
+
+
+def live(pipeline, db, last_slot_saved):
+    logging.info(f"Following the head of the chain from slot {last_slot_saved}")
+    last_gap_scan_slot = last_slot_saved
+    for head_slot in follow_head_slots(pipeline.beacon_client):
+        set_indexer_progress(head_slot, last_slot_saved)
+        if head_slot <= last_slot_saved:
+            continue
+        try:
+            indexed_slot = pipeline.run(last_slot_saved + 1, head_slot)
+        except Exception as e:
+            logging.error(f"Error indexing slots up to {head_slot}: {e}")
+            continue
+        if indexed_slot > last_slot_saved:
+            logging.info(f"Indexed slots {last_slot_saved + 1} to {indexed_slot}")
+            last_slot_saved = indexed_slot
+            set_indexer_progress(head_slot, last_slot_saved)
+        if last_slot_saved - last_gap_scan_slot >= SLOTS_PER_EPOCH:
+            repair_gaps(pipeline, db, last_slot_saved)
+            last_gap_scan_slot = last_slot_saved
+
+
+def repair_gaps(pipeline, db, end_slot, full_scan=False):
+    """
+    Index the slots missing up to end_slot, looking only after the indexed
+    checkpoint unless `full_scan` is set, then move the checkpoint to the
+    last slot before the first one still missing.
+    """
+    try:
+        checkpoint = 0 if full_scan else db.get_checkpoint(INDEXED_CHECKPOINT) or 0
+        if end_slot <= checkpoint:
+            return
+        gaps = db.get_missing_slot_ranges(checkpoint + 1, end_slot)
+    except Exception as e:
+        logging.error(f"Error looking for missing slots: {e}")
+        return
+    if len(gaps) > 0:
+        logging.info(
+            f"Found {sum(last - first + 1 for first, last in gaps)} missing slots in {len(gaps)} gaps between slots {checkpoint + 1} and {end_slot}"
+        )
+    for gap_start, gap_end in gaps:
+        try:
+            pipeline.run(gap_start, gap_end)
+        except Exception as e:
+            logging.error(f"Error indexing slots {gap_start} to {gap_end}: {e}")
+    try:
+        if len(gaps) > 0:
+            gaps = db.get_missing_slot_ranges(checkpoint + 1, end_slot)
+        if len(gaps) > 0:
+            logging.error(
+                f"Slots {gaps[0][0]} to {gaps[0][1]} are still missing, they will be retried later"
+            )
+        indexed_slot = gaps[0][0] - 1 if len(gaps) > 0 else end_slot
+        if indexed_slot > checkpoint:
+            db.set_checkpoint(INDEXED_CHECKPOINT, indexed_slot)
+    except Exception as e:
+        logging.error(f"Error saving the indexed checkpoint: {e}")
+
+
+def reindex_slots(pipeline, db, model_version, end_slot):
+    # The rows of previous model versions are kept, for comparison
+    start_slot = (db.get_checkpoint(REINDEX_CHECKPOINT, model_version) or 0) + 1
+    if start_slot > end_slot:
+        logging.info(f"Slots up to {end_slot} are already reindexed with this model")
+        return
+    logging.info(
+        f"Reindexing slots {start_slot} to {end_slot} with model {model_version}"
+    )
+    segments = split_slot_range(
+        start_slot, end_slot, pipeline.chunk_size * REINDEX_SEGMENT_BATCHES
     )
+    failures = 0
+    while len(segments) > 0:
+        segment_start, segment_end = segments[0]
+        try:
+            indexed_slot = pipeline.run(segment_start, segment_end)
+        except Exception as e:
+            logging.error(f"Error reindexing slots: {e}. Retrying...")
+            time.sleep(backoff_delay(failures))
+            failures += 1
+            continue
+        if len(pipeline.skipped_ranges) > 0:
+            # Their rows of previous models hide them from the gap scan, so
+            # the checkpoint stops before them and they are reindexed next time
+            indexed_slot = min(indexed_slot, pipeline.skipped_ranges[0][0] - 1)
+        if indexed_slot < segment_end:
+            if indexed_slot >= segment_start:
+                db.set_checkpoint(REINDEX_CHECKPOINT, indexed_slot, model_version)
+            logging.error(
+                f"Slot {indexed_slot + 1} could not be reindexed, stopping the reindex"
+            )
+            return
+        db.set_checkpoint(REINDEX_CHECKPOINT, indexed_slot, model_version)
+        logging.info(f"Reindexed slots up to {indexed_slot}")
+        segments.pop(0)
+        failures = 0
 
-    if guesses is not None:
-        start = time.time()
-        db.insert_client_guesses(guesses)
-        end = time.time()
-        logging.info("Inserted {} rows in {} seconds".format(len(guesses), end - start))
+
+def train_classifier(model_folder):
+    from blockprint.classifier import Classifier, VIABLE_FEATURES
+
+    if not os.path.exists(model_folder):
+        logging.error(
+            f"Model folder {model_folder} does not exist. Read the README.md for instructions on how to train the model"
+        )
+        exit(1)
+    logging.info(f"Loading model from {model_folder}...")
+    return Classifier(
+        model_folder,
+        graffiti_only_clients=[],
+        features=VIABLE_FEATURES,
+        classifier_type="mlp",
+        hidden_layer_sizes=(1165),
+    )
 
 
 def main():
@@ -84,98 +308,138 @@ def main():
     logging.basicConfig(level=logging.ERROR, format="%(levelname)s - %(message)s")
 
     args = parse_args()
+    profiler = StartupProfiler(args.profile_startup)
     model_folder = args.model_folder or DEFAULT_MODEL_FOLDER
     add_to_model = args.add_to_model
     node_url = args.node_url or DEFAULT_NODE_URL
     reindex = args.reindex or False
-    persisted_classifier_path = None
+    snapshot_path = None
     if args.persist_classifier:
-        if not args.persist_classifier.endswith(".pkl"):
-            logging.error(
-                f"Persisted classifier name should end with .pkl, got {args.persist_classifier}"
-            )
-            exit(1)
-        persisted_classifier_path = f"persisted_classifier/{args.persist_classifier}"
-        if not os.path.exists("persisted_classifier"):
-            os.makedirs("persisted_classifier")
+        # Names used to end with .pkl when the classifier was pickled
+        name = args.persist_classifier.removesuffix(".pkl")
+        snapshot_path = os.path.join(PERSISTED_CLASSIFIER_FOLDER, name)
+        if not os.path.exists(PERSISTED_CLASSIFIER_FOLDER):
+            os.makedirs(PERSISTED_CLASSIFIER_FOLDER)
 
     print("Reindex: {}".format(reindex))
 
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+
+    with profiler.phase("import blockprint"):
+        import blockprint.classifier
+
     # Load the model
     start = time.time()
-    if args.persist_classifier and os.path.exists(persisted_classifier_path):
-        logging.info(
-            f"Loading persisted classifier from {persisted_classifier_path}..."
-        )
-        classifier = pickle.load(open(persisted_classifier_path, "rb"))
-    else:
-        if not os.path.exists(model_folder):
-            logging.error(
-                f"Model folder {model_folder} does not exist. Read the README.md for instructions on how to train the model"
-            )
-            exit(1)
-        logging.info(f"Loading model from {model_folder}...")
-        classifier = Classifier(
-            model_folder,
-            graffiti_only_clients=[],
-            features=VIABLE_FEATURES,
-            classifier_type="mlp",
-            hidden_layer_sizes=(1165),
-        )
+    with profiler.phase("model load"):
+        if snapshot_path and snapshot_exists(snapshot_path):
+            logging.info(f"Loading classifier snapshot from {snapshot_path}...")
+            classifier = load_snapshot(snapshot_path)
+        elif snapshot_path and os.path.exists(f"{snapshot_path}.pkl"):
+            logging.info(f"Converting pickled classifier {snapshot_path}.pkl...")
+            with open(f"{snapshot_path}.pkl", "rb") as f:
+                save_snapshot(pickle.load(f), snapshot_path)
+            classifier = load_snapshot(snapshot_path)
+        else:
+            classifier = train_classifier(model_folder)
+            if snapshot_path:
+                logging.info(f"Persisting classifier to {snapshot_path}...")
+                save_snapshot(classifier, snapshot_path)
+                classifier = load_snapshot(snapshot_path)
+
+    end = time.time()
+    logging.info(f"Classifier loaded, took {end - start} seconds")
 
-    if persisted_classifier_path:
-        persist_classifier(
+    model_updater = None
+    if add_to_model and args.retrain_folder:
+        model_updater = ModelUpdater(
+            train_classifier,
+            model_folder,
+            args.retrain_folder,
             classifier,
-            persisted_classifier_path.split(".pkl")[0],
+            retrain_samples=args.retrain_samples,
+            retrain_interval=args.retrain_interval,
         )
-        logging.info(f"Persisting classifier to {persisted_classifier_path}...")
+        classifier = model_updater.classifier
+        model_updater.start()
 
-    end = time.time()
-    logging.info(f"Classifier loaded, took {end - start} seconds")
+    # The days of the daily aggregates are those of the node's network
+    beacon_client = BeaconClient(node_url)
+    genesis_time = beacon_client.genesis_time()
+    logging.info(f"Genesis time: {genesis_time}")
 
     logging.info("Connecting to database...")
-    db_client = ClickHouseDB(args.clickhouse_endpoint)
-    logging.info("Connected to database")
-    db_client.create_table()
-
-    last_slot_saved = db_client.get_max_slot()
+    with profiler.phase("database setup"):
+        db_client = ClickHouseDB(
+            args.clickhouse_endpoint, args.compression, args.async_insert
+        )
+        logging.info("Connected to database")
+        db_client.create_table(genesis_time=genesis_time)
+        last_slot_saved = db_client.get_max_slot()
     if last_slot_saved is None:
         last_slot_saved = 0
     logging.info(f"Last slot saved: {last_slot_saved}")
 
-    while True:
+    # Snapshots carry a content hash, other classifiers are identified by the
+    # files they were trained from
+    model_version = getattr(classifier, "fingerprint", None) or model_fingerprint(
+        model_folder
+    )
+    logging.info(f"Model version: {model_version}")
+    # The guesses of the model doing the indexing are the ones served
+    db_client.set_active_model_version(model_version)
+
+    feature_store = None
+    if args.feature_store:
+        feature_store = open_feature_store(args.feature_store, classifier)
+
+    if args.classify_workers > 0:
+        if getattr(classifier, "path", None) is None:
+            logging.warning(
+                "--classify-workers needs --persist-classifier, classifying in this process"
+            )
+        else:
+            set_classify_pool(ClassifierPool(args.classify_workers))
+            logging.info(f"Classifying with {args.classify_workers} processes")
+
+    pipeline = BackfillPipeline(
+        classifier,
+        db_client,
+        node_url,
+        model_folder,
+        add_to_model,
+        chunk_size=args.batch_size,
+        download_workers=args.download_workers,
+        queue_size=args.queue_size,
+        model_version=model_version,
+        store_features=not args.no_store_features,
+        feature_store=feature_store,
+        model_updater=model_updater,
+        beacon_client=beacon_client,
+    )
+
+    profiler.report()
+
+    if reindex:
         start = time.time()
-        try:
-            head_slot = get_node_head_slot(node_url)
-        except Exception as e:
-            logging.error(f"Error getting head slot: {e}. Retrying...")
-            time.sleep(5)
-            continue
-        logging.info(f"Head slot: {head_slot}")
-        targetSlot = min(
-            last_slot_saved + DEFAULT_BACKFILLING_BATCH_SIZE,
-            head_slot,
+        reindex_slots(pipeline, db_client, model_version, last_slot_saved)
+        end = time.time()
+        logging.info(f"Reindex done, took {end - start} seconds")
+
+    repair_gaps(pipeline, db_client, last_slot_saved, full_scan=args.mode == "gaps")
+    if args.mode == "gaps":
+        return
+
+    if args.mode in ("auto", "backfill"):
+        start = time.time()
+        last_slot_saved = backfill(pipeline, last_slot_saved)
+        end = time.time()
+        logging.info(
+            f"Backfilled up to slot {last_slot_saved}, took {end - start} seconds"
         )
-        if targetSlot > last_slot_saved:
-            try:
-                loadSlotGuessesDatabase(
-                    last_slot_saved + 1,
-                    targetSlot,
-                    classifier,
-                    model_folder,
-                    node_url,
-                    add_to_model,
-                    db_client,
-                )
-            except EndSlotUnkown:
-                logging.info("End slot unknown, waiting for next slot")
-                time.sleep(0.5)
-                continue
-            last_slot_saved += targetSlot - last_slot_saved
-            end = time.time()
-            time.sleep(max(0, 12 - (end - start)))
-        else:
-            time.sleep(0.5)
+        repair_gaps(pipeline, db_client, last_slot_saved)
+    if args.mode in ("auto", "live"):
+        live(pipeline, db_client, last_slot_saved)
 
 
 if __name__ == "__main__":
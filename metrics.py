@@ -0,0 +1,137 @@
+import logging
+import os
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Covers a classified block (milliseconds) up to a large download (minutes)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _NoopMetric:
+    # Stands in for every metric when prometheus_client isn't installed
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(kind, *args, **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    if kind == "Gauge" and "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Gunicorn workers each have their own value, the latest one is exposed
+        kwargs["multiprocess_mode"] = "mostrecent"
+    return getattr(prometheus_client, kind)(*args, **kwargs)
+
+
+STAGE_SECONDS = _metric(
+    "Histogram",
+    "blockprint_stage_seconds",
+    "Time spent in each stage of classifying and indexing slots",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+SLOTS = _metric(
+    "Counter",
+    "blockprint_slots",
+    "Slots handled by the indexer, by kind: block or missing (no block was proposed) once downloaded, skipped after a download or classification error, left for the gap repair",
+    ["kind"],
+)
+INDEXER_HEAD_SLOT = _metric(
+    "Gauge", "blockprint_indexer_head_slot", "Head slot of the beacon node"
+)
+INDEXER_INDEXED_SLOT = _metric(
+    "Gauge",
+    "blockprint_indexer_indexed_slot",
+    "Last slot processed by the indexer, the skipped slots before it are inserted later by the gap repair",
+)
+INDEXER_LAG_SLOTS = _metric(
+    "Gauge",
+    "blockprint_indexer_lag_slots",
+    "Number of slots the indexer is behind the head of the beacon node",
+)
+QUEUE_DEPTH = _metric(
+    "Gauge",
+    "blockprint_queue_depth",
+    "Items waiting in a queue: downloaded chunks waiting to be classified, classified chunks waiting to be inserted",
+    ["queue"],
+)
+CACHE_SLOTS = _metric(
+    "Counter",
+    "blockprint_cache_slots",
+    "Slots looked up in the server's guess cache, by result: hit or miss",
+    ["result"],
+)
+REQUEST_SECONDS = _metric(
+    "Histogram",
+    "blockprint_request_seconds",
+    "Time to answer server requests, by endpoint",
+    ["endpoint"],
+    buckets=REQUEST_BUCKETS,
+)
+
+
+def observe_slots(start_slot, end_slot, blocks):
+    SLOTS.labels("block").inc(blocks)
+    SLOTS.labels("missing").inc(end_slot - start_slot + 1 - blocks)
+
+
+def set_indexer_progress(head_slot, indexed_slot):
+    INDEXER_HEAD_SLOT.set(head_slot)
+    INDEXER_INDEXED_SLOT.set(indexed_slot)
+    INDEXER_LAG_SLOTS.set(max(head_slot - indexed_slot, 0))
+
+
+def generate():
+    """
+    (body, content type) of the metrics of this process, or of every
+    process sharing PROMETHEUS_MULTIPROC_DIR, such as gunicorn workers.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    if prometheus_client is None:
+        logging.error("prometheus_client is not installed, metrics are not exposed")
+        return
+    prometheus_client.start_http_server(port, host)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+def add_metrics_argument(parser):
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Expose Prometheus metrics on this port, at /metrics. Needs prometheus_client",
+    )
@@ -0,0 +1,191 @@
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+from snapshot import load_snapshot, save_snapshot
+
+DEFAULT_RETRAIN_SAMPLES = 1000
+DEFAULT_RETRAIN_INTERVAL = 600
+POLL_INTERVAL = 30
+CURRENT_NAME = "current.json"
+LOCK_NAME = "lock"
+# Niceness of the training process, so serving keeps the CPU it needs
+RETRAIN_NICENESS = 10
+
+
+def count_samples(model_folder):
+    # lb.store_block_rewards writes one file per labelled block
+    return sum(len(files) for _, _, files in os.walk(model_folder))
+
+
+def _read_current(retrain_folder):
+    try:
+        with open(os.path.join(retrain_folder, CURRENT_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _retrain(train, model_folder, retrain_folder):
+    # Runs in its own process
+    os.nice(RETRAIN_NICENESS)
+    samples = count_samples(model_folder)
+    classifier = train(model_folder)
+    name = f"model-{time.time_ns()}"
+    save_snapshot(classifier, os.path.join(retrain_folder, name))
+    previous = _read_current(retrain_folder)
+    tmp_path = os.path.join(retrain_folder, f"{CURRENT_NAME}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "snapshot": name,
+                "model_folder": os.path.abspath(model_folder),
+                "samples": samples,
+            },
+            f,
+        )
+    os.replace(tmp_path, os.path.join(retrain_folder, CURRENT_NAME))
+    # The previous snapshot may still be loading in other processes
+    keep = {name, previous and previous["snapshot"]}
+    for entry in os.listdir(retrain_folder):
+        if entry.startswith("model-") and entry not in keep:
+            shutil.rmtree(os.path.join(retrain_folder, entry), ignore_errors=True)
+
+
+class ModelUpdater:
+    """
+    Retrains the classifier with the blocks --add-to-model keeps adding to
+    the model folder, and swaps the new model in without blocking requests.
+    Once `retrain_samples` files were added since the last training, and at
+    most every `retrain_interval` seconds, `train(model_folder)` runs in a
+    separate, lower priority process that writes a snapshot of the result
+    to `retrain_folder`. Every process sharing the folder, such as gunicorn
+    workers, then loads the snapshot in a background thread, replaces
+    `classifier` with it and calls `on_update(classifier)`. A lock file
+    makes sure only one of them trains at a time.
+    """
+
+    def __init__(
+        self,
+        train,
+        model_folder,
+        retrain_folder,
+        classifier,
+        on_update=None,
+        retrain_samples=DEFAULT_RETRAIN_SAMPLES,
+        retrain_interval=DEFAULT_RETRAIN_INTERVAL,
+    ):
+        self.train = train
+        self.model_folder = model_folder
+        self.retrain_folder = retrain_folder
+        self.on_update = on_update
+        self.retrain_samples = retrain_samples
+        self.retrain_interval = retrain_interval
+        self.last_retrain = 0
+        self.lock = threading.Lock()
+        self.thread_pid = None
+        os.makedirs(retrain_folder, exist_ok=True)
+
+        self.classifier = classifier
+        self.current = None
+        self.trained_samples = count_samples(model_folder)
+        # Start from the last model retrained from this model folder
+        current = _read_current(retrain_folder)
+        if current is not None and current["model_folder"] == os.path.abspath(
+            model_folder
+        ):
+            self._load(current)
+
+    def start(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _load(self, current):
+        path = os.path.join(self.retrain_folder, current["snapshot"])
+        classifier = load_snapshot(path)
+        self.current = current
+        self.trained_samples = current["samples"]
+        # A single assignment, requests get either the old or the new model
+        self.classifier = classifier
+        logging.info(
+            f"Using model {classifier.fingerprint} retrained with {current['samples']} samples"
+        )
+
+    def _run(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f"Error updating the model: {e}")
+
+    def poll(self):
+        current = _read_current(self.retrain_folder)
+        if current is not None and current != self.current:
+            self._load(current)
+            if self.on_update is not None:
+                self.on_update(self.classifier)
+        new_samples = count_samples(self.model_folder) - self.trained_samples
+        if (
+            new_samples >= self.retrain_samples
+            and time.monotonic() - self.last_retrain >= self.retrain_interval
+        ):
+            self.retrain(new_samples)
+
+    def retrain(self, new_samples):
+        with open(os.path.join(self.retrain_folder, LOCK_NAME), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already training
+                return
+            self.last_retrain = time.monotonic()
+            if _read_current(self.retrain_folder) != self.current:
+                # Trained by another process meanwhile, loaded on the next poll
+                return
+            logging.info(f"Retraining the model with {new_samples} new samples...")
+            start = time.time()
+            # Spawned rather than forked, this process runs threads
+            process = multiprocessing.get_context("spawn").Process(
+                target=_retrain,
+                args=(self.train, self.model_folder, self.retrain_folder),
+                daemon=True,
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                logging.error(f"Retraining failed with exit code {process.exitcode}")
+                return
+            logging.info(f"Model retrained, took {time.time() - start} seconds")
+        self.poll()
+
+
+def add_retrain_arguments(parser):
+    parser.add_argument(
+        "--retrain-folder",
+        type=str,
+        help="With --add-to-model, retrain the classifier in the background with the added blocks and switch to the new model without restarting. The retrained models are stored in this folder, and the last one is used on startup",
+    )
+    parser.add_argument(
+        "--retrain-samples",
+        default=DEFAULT_RETRAIN_SAMPLES,
+        type=int,
+        help=f"Number of blocks added to the model folder before it is retrained (default: {DEFAULT_RETRAIN_SAMPLES})",
+    )
+    parser.add_argument(
+        "--retrain-interval",
+        default=DEFAULT_RETRAIN_INTERVAL,
+        type=int,
+        help=f"Minimum number of seconds between two retrainings (default: {DEFAULT_RETRAIN_INTERVAL})",
+    )
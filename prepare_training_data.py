@@ -1,21 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import functools
+import hashlib
+import json
+import logging
 import multiprocessing
 import os
-import concurrent.futures
+import time
 
-import blockprint.load_blocks as lb
 import blockprint.prepare_training_data as ptd
 
+from guess_requester import download_block_rewards, split_slot_range
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_DOWNLOAD_WORKERS = 2
+# Kept in the training data folder, hidden so it isn't taken for a raw file
+MANIFEST_NAME = ".processed.json"
+
 def parseArgs():
     parser = argparse.ArgumentParser(description="Load blocks and prepare training data")
     parser.add_argument("start_slot", type=int, help="Slot to start loading blocks from")
     parser.add_argument("end_slot", type=int, help="Slot to end loading blocks at")
     parser.add_argument("training_data_folder", type=str, help="Path to the folder to use for the training data")
     parser.add_argument("model_folder", type=str, help="Path to the folder to use for the model")
-    parser.add_argument("--node-url", type=str, default="http://localhost:5052", help="URL of the beacon node to download blocks from (default: http://localhost:5052)")
+    parser.add_argument("--node-url", type=str, default="http://localhost:5052", help="URL of the beacon node to download blocks from. Several comma-separated URLs can be given (default: http://localhost:5052)")
     parser.add_argument(
         "--disable",
         default=[],
@@ -28,35 +38,221 @@ def parseArgs():
         type=int,
         help="number of parallel processes to utilize",
     )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Only download the batches missing from the training data folder, and only process the files that changed since they were last processed into the model folder",
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BATCH_SIZE,
+        type=int,
+        help=f"Number of slots per downloaded file (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--download-workers",
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        type=int,
+        help=f"Number of batches downloaded concurrently (default: {DEFAULT_DOWNLOAD_WORKERS})",
+    )
     return parser.parse_args()
 
-def load_blocks(args):
-    lb.download_block_reward_batches(args.start_slot, args.end_slot, args.training_data_folder, args.node_url)
+def batch_file_name(start_slot, end_slot):
+    return f"slot_{start_slot}_to_{end_slot}.json"
+
+def list_raw_files(raw_data_dir):
+    return sorted(
+        name
+        for name in os.listdir(raw_data_dir)
+        if name.endswith(".json") and not name.startswith(".")
+    )
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_state(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+class ProcessedManifest:
+    """
+    Raw files already processed into a model folder. A file is processed
+    again if its size or mtime changed and its hash changed too. Processing
+    into another model folder, or with other disabled clients, starts over.
+    """
+
+    def __init__(self, raw_data_dir, proc_data_dir, disabled_clients):
+        self.path = os.path.join(raw_data_dir, MANIFEST_NAME)
+        self.target = {
+            "model_folder": os.path.abspath(proc_data_dir),
+            "disabled": sorted(disabled_clients),
+        }
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if {key: manifest.get(key) for key in self.target} == self.target:
+                self.files = manifest["files"]
+            else:
+                logging.info(
+                    "Files were processed into another model folder or with other disabled clients, processing them all again"
+                )
+
+    def is_processed(self, raw_data_dir, name):
+        entry = self.files.get(name)
+        if entry is None:
+            return False
+        path = os.path.join(raw_data_dir, name)
+        state = file_state(path)
+        if state == {key: entry[key] for key in state}:
+            return True
+        if state["size"] == entry["size"] and file_digest(path) == entry["sha256"]:
+            # Touched but unchanged
+            entry.update(state)
+            return True
+        return False
+
+    def record(self, name, state):
+        self.files[name] = state
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({**self.target, "files": self.files}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+def download_batch(raw_data_dir, start_slot, end_slot, node_url):
+    start = time.perf_counter()
+    block_rewards = download_block_rewards(start_slot, end_slot, node_url)
+    name = batch_file_name(start_slot, end_slot)
+    # Renamed once complete, so an interrupted download is never processed
+    tmp_path = os.path.join(raw_data_dir, f".{name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(block_rewards, f)
+    os.replace(tmp_path, os.path.join(raw_data_dir, name))
+    return name, len(block_rewards), time.perf_counter() - start
+
+def process_raw_file(raw_data_dir, proc_data_dir, disabled_clients, name):
+    # Runs in a worker process; the state is taken before processing so a
+    # file rewritten meanwhile is processed again next time
+    path = os.path.join(raw_data_dir, name)
+    state = file_state(path)
+    state["sha256"] = file_digest(path)
+    start = time.perf_counter()
+    ptd.process_file(raw_data_dir, proc_data_dir, disabled_clients, name)
+    return state, time.perf_counter() - start
 
 def prepare_training_data(args):
+    """
+    Download the slot range in batches while the downloaded files, and the
+    ones already in the training data folder, are processed into the model
+    folder by a pool of processes. Returns the names of the batches and files
+    that failed.
+    """
     raw_data_dir = args.training_data_folder
     proc_data_dir = args.model_folder
-    parallel_workers = args.num_workers
     disabled_clients = args.disable
+    os.makedirs(raw_data_dir, exist_ok=True)
+    manifest = ProcessedManifest(raw_data_dir, proc_data_dir, disabled_clients)
 
-    input_files = os.listdir(raw_data_dir)
+    batches = split_slot_range(args.start_slot, args.end_slot, args.batch_size)
+    if args.incremental:
+        existing = set(list_raw_files(raw_data_dir))
+        batches = [batch for batch in batches if batch_file_name(*batch) not in existing]
+    downloaded_names = {batch_file_name(*batch) for batch in batches}
+    logging.info(f"Downloading {len(batches)} batches of slots {args.start_slot} to {args.end_slot}")
 
-    with concurrent.futures.ProcessPoolExecutor(
-        max_workers=parallel_workers
-    ) as executor:
-        partial = functools.partial(
-            ptd.process_file, raw_data_dir, proc_data_dir, disabled_clients
-        )
-        executor.map(partial, input_files)
+    failures = []
+    totals = {"downloaded": 0, "blocks": 0, "processed": 0, "bytes": 0, "skipped": 0}
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.download_workers
+    ) as download_executor, concurrent.futures.ProcessPoolExecutor(
+        # Not forked, since the download threads are already running
+        max_workers=args.num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as process_executor:
+        process = functools.partial(process_raw_file, raw_data_dir, proc_data_dir, disabled_clients)
+        downloads = {
+            download_executor.submit(download_batch, raw_data_dir, *batch, args.node_url): batch
+            for batch in batches
+        }
+        processing = {}
+
+        pending = set(downloads)
+
+        def submit(name):
+            if args.incremental and manifest.is_processed(raw_data_dir, name):
+                totals["skipped"] += 1
+                return
+            future = process_executor.submit(process, name)
+            processing[future] = name
+            pending.add(future)
+
+        # Files already there are processed while the rest downloads
+        for name in list_raw_files(raw_data_dir):
+            if name not in downloaded_names:
+                submit(name)
+
+        try:
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                pending -= done
+                for future in done:
+                    if future in downloads:
+                        batch_start, batch_end = downloads[future]
+                        try:
+                            name, blocks, seconds = future.result()
+                        except Exception as e:
+                            logging.error(f"Failed to download slots {batch_start} to {batch_end}: {e}")
+                            failures.append(batch_file_name(batch_start, batch_end))
+                            continue
+                        totals["downloaded"] += 1
+                        totals["blocks"] += blocks
+                        logging.info(f"Downloaded {name}: {blocks} blocks in {seconds:.2f} seconds")
+                        submit(name)
+                        continue
+                    name = processing.pop(future)
+                    try:
+                        state, seconds = future.result()
+                    except Exception as e:
+                        # Not recorded, so the next run processes it again
+                        logging.error(f"Failed to process {name}: {e!r}")
+                        failures.append(name)
+                        continue
+                    manifest.record(name, state)
+                    totals["processed"] += 1
+                    totals["bytes"] += state["size"]
+                    logging.info(f"Processed {name} ({state['size'] / 1e6:.1f} MB) in {seconds:.2f} seconds")
+        finally:
+            manifest.save()
+            for future in pending:
+                future.cancel()
+
+    seconds = time.perf_counter() - start
+    logging.info(
+        f"Downloaded {totals['downloaded']} files with {totals['blocks']} blocks ({totals['blocks'] / seconds:.1f} blocks/s), "
+        f"processed {totals['processed']} files ({totals['bytes'] / 1e6 / seconds:.1f} MB/s), "
+        f"skipped {totals['skipped']} already processed files, {len(failures)} failures, in {seconds:.2f} seconds"
+    )
+    return failures
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+
     args = parseArgs()
 
-    try:
-        load_blocks(args)
-        prepare_training_data(args)
-    except Exception as e:
-        print(e)
+    failures = prepare_training_data(args)
+    if failures:
+        logging.error(f"Failed: {', '.join(failures)}")
+        exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_CACHE_SIZE = 100000
+
+
+def model_fingerprint(model_folder):
+    # Cheap stand-in for a content hash: any retrained or added file changes it
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(model_folder)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            path = os.path.relpath(os.path.join(root, name), model_folder)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def missing_slot_ranges(start_slot, end_slot, cached_slots):
+    ranges = []
+    range_start = None
+    for slot in range(start_slot, end_slot + 1):
+        if slot in cached_slots:
+            if range_start is not None:
+                ranges.append((range_start, slot - 1))
+                range_start = None
+        elif range_start is None:
+            range_start = slot
+    if range_start is not None:
+        ranges.append((range_start, end_slot))
+    return ranges
+
+
+class SlotGuessCache:
+    """
+    Guesses keyed by (model fingerprint, slot), in a bounded in-memory LRU
+    backed by an optional sqlite file. The file can be shared by several
+    processes serving the same model.
+    """
+
+    def __init__(self, fingerprint, max_size=DEFAULT_CACHE_SIZE, path=None):
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._connection_pid = None
+
+    def _disk(self):
+        if self.path is None:
+            return None
+        # sqlite connections can't be shared with forked worker processes
+        if self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS slot_guesses (
+                    fingerprint TEXT,
+                    slot INTEGER,
+                    guess TEXT,
+                    PRIMARY KEY (fingerprint, slot)
+                ) WITHOUT ROWID"""
+            )
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def set_fingerprint(self, fingerprint):
+        # Guesses of the previous model stay cached under its fingerprint
+        # until they are evicted
+        with self.lock:
+            self.fingerprint = fingerprint
+
+    def _remember(self, slot, guess):
+        self.entries[(self.fingerprint, slot)] = guess
+        self.entries.move_to_end((self.fingerprint, slot))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_range(self, start_slot, end_slot):
+        found = {}
+        with self.lock:
+            for slot in range(start_slot, end_slot + 1):
+                guess = self.entries.get((self.fingerprint, slot))
+                if guess is not None:
+                    self.entries.move_to_end((self.fingerprint, slot))
+                    found[slot] = guess
+            disk = self._disk()
+            if disk is not None and len(found) < end_slot - start_slot + 1:
+                rows = disk.execute(
+                    "SELECT slot, guess FROM slot_guesses WHERE fingerprint = ? AND slot BETWEEN ? AND ?",
+                    (self.fingerprint, start_slot, end_slot),
+                )
+                for slot, guess in rows:
+                    if slot not in found:
+                        found[slot] = json.loads(guess)
+                        self._remember(slot, found[slot])
+            self.hits += len(found)
+            self.misses += end_slot - start_slot + 1 - len(found)
+        metrics.CACHE_SLOTS.labels("hit").inc(len(found))
+        metrics.CACHE_SLOTS.labels("miss").inc(end_slot - start_slot + 1 - len(found))
+        return found
+
+    def put_many(self, guesses):
+        if len(guesses) == 0:
+            return
+        with self.lock:
+            for guess in guesses:
+                self._remember(guess["slot"], guess)
+            disk = self._disk()
+            if disk is not None:
+                with disk:
+                    disk.executemany(
+                        "INSERT OR REPLACE INTO slot_guesses VALUES (?, ?, ?)",
+                        [
+                            (self.fingerprint, guess["slot"], json.dumps(guess))
+                            for guess in guesses
+                        ],
+                    )
+
+
+def iterMergedSlotGuesses(start_slot, end_slot, known, fetch):
+    """
+    Yield the guesses for start_slot..end_slot in slot order, taking them from
+    the `known` dict (slot -> guess) and calling fetch(range_start, range_end)
+    for the ranges it doesn't cover.
+    """
+    next_slot = start_slot
+    for range_start, range_end in missing_slot_ranges(start_slot, end_slot, known):
+        for slot in range(next_slot, range_start):
+            yield known[slot]
+        yield from fetch(range_start, range_end)
+        next_slot = range_end + 1
+    for slot in range(next_slot, end_slot + 1):
+        yield known[slot]
+
+
+def iterCachedSlotGuesses(cache, start_slot, end_slot, finalized_slot, fetch):
+    # Fetched guesses are cached once their slot is finalized
+    def fetch_and_cache(range_start, range_end):
+        finalized = []
+        for guess in fetch(range_start, range_end):
+            if guess["slot"] <= finalized_slot:
+                finalized.append(guess)
+            yield guess
+        cache.put_many(finalized)
+
+    return iterMergedSlotGuesses(
+        start_slot, end_slot, cache.get_range(start_slot, end_slot), fetch_and_cache
+    )
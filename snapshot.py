@@ -0,0 +1,289 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# Distances SnapshotKNN computes at once, bounding the memory of a batch
+KNN_DISTANCES_PER_BLOCK = 1 << 22
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _hidden_activation(name, x):
+    if name == "identity":
+        return x
+    if name == "relu":
+        return np.maximum(x, 0)
+    if name == "tanh":
+        return np.tanh(x)
+    if name == "logistic":
+        return 1 / (1 + np.exp(-x))
+    raise SnapshotError(f"Unsupported activation {name}")
+
+
+def graffiti_only_guess(enabled_clients, graffiti_guess):
+    # Same as Classifier.classify: the graffiti is trusted over the model
+    prob_by_client = {client: 0.0 for client in enabled_clients}
+    prob_by_client[graffiti_guess] = 1.0
+    return (graffiti_guess, graffiti_guess, prob_by_client, graffiti_guess)
+
+
+class SnapshotMLP:
+    # Forward pass of sklearn's MLPClassifier.predict_proba over mapped weights
+    def __init__(self, coefs, intercepts, activation, out_activation, mean, scale):
+        self.coefs = coefs
+        self.intercepts = intercepts
+        self.activation = activation
+        self.out_activation = out_activation
+        self.mean = mean
+        self.scale = scale
+
+    def predict_proba(self, X):
+        activations = np.asarray(X, dtype=np.float64)
+        if self.mean is not None:
+            activations = (activations - self.mean) / self.scale
+        for i, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+            activations = activations @ coef + intercept
+            if i < len(self.coefs) - 1:
+                activations = _hidden_activation(self.activation, activations)
+        if self.out_activation == "softmax":
+            activations = np.exp(activations - activations.max(axis=1, keepdims=True))
+            return activations / activations.sum(axis=1, keepdims=True)
+        if self.out_activation == "logistic":
+            positive = 1 / (1 + np.exp(-activations.ravel()))
+            return np.vstack([1 - positive, positive]).T
+        raise SnapshotError(f"Unsupported output activation {self.out_activation}")
+
+
+class SnapshotKNN:
+    """
+    sklearn's KNeighborsClassifier.predict_proba (Euclidean distance) by
+    brute force over the mapped training set, so processes loading the same
+    snapshot share it instead of each fitting its own neighbour tree.
+    """
+
+    def __init__(
+        self, fit_X, label_indices, class_count, n_neighbors, weights, mean, scale
+    ):
+        self.fit_X = fit_X
+        self.label_indices = label_indices
+        self.class_count = class_count
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.mean = mean
+        self.scale = scale
+        # Squared norms of the training rows, for the distances of a whole block
+        self.fit_sq_norms = np.einsum("ij,ij->i", fit_X, fit_X)
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if self.mean is not None:
+            X = (X - self.mean) / self.scale
+        block_size = max(1, KNN_DISTANCES_PER_BLOCK // len(self.fit_X))
+        return np.vstack(
+            [
+                self._predict_block(X[block_start : block_start + block_size])
+                for block_start in range(0, len(X), block_size)
+            ]
+        )
+
+    def _predict_block(self, X):
+        k = min(self.n_neighbors, len(self.fit_X))
+        sq_distances = self.fit_sq_norms - 2 * (X @ self.fit_X.T)
+        neighbors = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+        # Exact distances of the neighbours, so duplicates of a training row
+        # are at 0 like they are for sklearn
+        distances = np.linalg.norm(X[:, None, :] - self.fit_X[neighbors], axis=2)
+        if self.weights == "uniform":
+            weights = np.ones_like(distances)
+        else:
+            with np.errstate(divide="ignore"):
+                weights = 1 / distances
+            # Rows matching training rows only get the classes of those
+            exact_rows = np.isinf(weights).any(axis=1)
+            weights[exact_rows] = np.isinf(weights[exact_rows])
+        rows = np.arange(len(X))
+        proba = np.zeros((len(X), self.class_count))
+        labels = self.label_indices[neighbors]
+        for j in range(k):
+            proba[rows, labels[:, j]] += weights[:, j]
+        return proba / proba.sum(axis=1, keepdims=True)
+
+
+class SnapshotClassifier:
+    """
+    Drop-in replacement for blockprint's Classifier backed by a snapshot
+    written by save_snapshot. `classifier` is the model used by
+    classify_block_rewards, `fingerprint` identifies the snapshot content.
+    """
+
+    def __init__(self, path, manifest, model):
+        self.path = path
+        self.manifest = manifest
+        self.classifier = model
+        self.features = manifest["features"]
+        self.enabled_clients = manifest["enabled_clients"]
+        self.graffiti_only_clients = set(manifest["graffiti_only_clients"])
+        self.fingerprint = manifest["content_hash"][:16]
+
+    def classify(self, block_reward):
+        from blockprint.classifier import (
+            compute_best_guess,
+            compute_guess_list,
+            compute_multilabel,
+            into_feature_row,
+        )
+        import blockprint.prepare_training_data as pt
+
+        graffiti_guess = pt.classify_reward_by_graffiti(block_reward)
+        if graffiti_guess in self.graffiti_only_clients:
+            return graffiti_only_guess(self.enabled_clients, graffiti_guess)
+        row = into_feature_row(block_reward, self.features)
+        probabilities = self.classifier.predict_proba([row])[0].tolist()
+        prob_by_client = dict(zip(self.enabled_clients, probabilities))
+        multilabel = compute_multilabel(
+            compute_guess_list(prob_by_client, self.enabled_clients)
+        )
+        label = compute_best_guess(prob_by_client)
+        return (label, multilabel, prob_by_client, graffiti_guess)
+
+
+def _split_scaler(model):
+    # Plain estimators, or sklearn Pipelines of a StandardScaler and an estimator
+    steps = getattr(model, "steps", None)
+    if steps is None:
+        return None, model
+    if len(steps) != 2 or not hasattr(steps[0][1], "scale_"):
+        raise SnapshotError("Only a StandardScaler followed by a model is supported")
+    return steps[0][1], steps[1][1]
+
+
+def _content_hash(manifest, arrays):
+    digest = hashlib.sha256()
+    metadata = {key: value for key, value in manifest.items() if key != "content_hash"}
+    digest.update(json.dumps(metadata, sort_keys=True).encode())
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()
+
+
+def save_snapshot(classifier, path):
+    scaler, model = _split_scaler(classifier.classifier)
+    arrays = {}
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "features": list(classifier.features),
+        "enabled_clients": list(classifier.enabled_clients),
+        "graffiti_only_clients": sorted(
+            getattr(classifier, "graffiti_only_clients", [])
+        ),
+    }
+    if scaler is not None:
+        arrays["scaler_mean"] = scaler.mean_
+        arrays["scaler_scale"] = scaler.scale_
+    if hasattr(model, "coefs_"):
+        manifest["classifier_type"] = "mlp"
+        manifest["activation"] = model.activation
+        manifest["out_activation"] = model.out_activation_
+        manifest["layers"] = len(model.coefs_)
+        for i, (coef, intercept) in enumerate(zip(model.coefs_, model.intercepts_)):
+            arrays[f"coef_{i}"] = coef
+            arrays[f"intercept_{i}"] = intercept
+    elif hasattr(model, "_fit_X"):
+        if model.effective_metric_ != "euclidean" or model.weights not in (
+            "uniform",
+            "distance",
+        ):
+            raise SnapshotError(
+                f"Unsupported neighbours model, metric {model.effective_metric_} and weights {model.weights}"
+            )
+        manifest["classifier_type"] = "knn"
+        manifest["n_neighbors"] = model.n_neighbors
+        manifest["weights"] = model.weights
+        # Labels may be strings, which can't be memory-mapped
+        manifest["classes"] = model.classes_.tolist()
+        arrays["fit_X"] = model._fit_X
+        arrays["label_indices"] = model._y
+    else:
+        raise SnapshotError(f"Unsupported model {type(model).__name__}")
+    manifest["arrays"] = sorted(arrays)
+    manifest["content_hash"] = _content_hash(manifest, arrays)
+
+    # Written next to the destination and swapped in, so readers never see
+    # a partial snapshot
+    path = os.path.normpath(path)
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    if os.path.exists(path):
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.rename(tmp_path, path)
+    return manifest
+
+
+def snapshot_exists(path):
+    return os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def load_snapshot(path, verify=False):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(
+            f"Snapshot format {manifest.get('format_version')} is not supported, expected {FORMAT_VERSION}"
+        )
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in manifest["arrays"]
+    }
+    if verify and _content_hash(manifest, arrays) != manifest["content_hash"]:
+        raise SnapshotError(f"Snapshot {path} doesn't match its content hash")
+
+    mean = arrays.get("scaler_mean")
+    scale = arrays.get("scaler_scale")
+    if manifest["classifier_type"] == "mlp":
+        model = SnapshotMLP(
+            [arrays[f"coef_{i}"] for i in range(manifest["layers"])],
+            [arrays[f"intercept_{i}"] for i in range(manifest["layers"])],
+            manifest["activation"],
+            manifest["out_activation"],
+            mean,
+            scale,
+        )
+    else:
+        model = SnapshotKNN(
+            arrays["fit_X"],
+            arrays["label_indices"],
+            len(manifest["classes"]),
+            manifest["n_neighbors"],
+            manifest["weights"],
+            mean,
+            scale,
+        )
+    return SnapshotClassifier(path, manifest, model)
+
+
+def load_or_create_snapshot(path, train):
+    # The trained classifier is dropped so every run serves the same mapped model
+    if not snapshot_exists(path):
+        logging.info(f"No snapshot at {path}, training the classifier...")
+        save_snapshot(train(), path)
+        logging.info(f"Classifier snapshot written to {path}")
+    return load_snapshot(path)
@@ -0,0 +1,62 @@
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+# Entry points import this module first, so this is close to the moment the
+# interpreter started running our code
+PROCESS_START = time.perf_counter()
+
+
+class StartupProfiler:
+    """
+    Records how long each startup phase of an entry point takes, and how long
+    after the start of the process the first request was answered. Nothing
+    is logged unless `enabled` is set (--profile-startup).
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = [("module imports", time.perf_counter() - PROCESS_START)]
+        self.first_request_done = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        modules_before = len(sys.modules)
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+            if self.enabled:
+                logging.info(
+                    f"Startup: {name} took {self.phases[-1][1]:.3f} seconds, {len(sys.modules) - modules_before} modules imported"
+                )
+
+    def report(self):
+        if not self.enabled:
+            return
+        logging.info("Startup profile:")
+        for name, seconds in self.phases:
+            logging.info(f"  {name:<24} {seconds:8.3f} s")
+        logging.info(
+            f"  {'total':<24} {time.perf_counter() - PROCESS_START:8.3f} s ({len(sys.modules)} modules loaded)"
+        )
+
+    def first_request(self, seconds):
+        # Workers forked by gunicorn each report their own first request
+        if not self.enabled or self.first_request_done:
+            return
+        self.first_request_done = True
+        logging.info(
+            f"Startup: first request took {seconds:.3f} seconds, answered {time.perf_counter() - PROCESS_START:.3f} seconds after the process started"
+        )
+
+
+def add_profile_startup_argument(parser):
+    parser.add_argument(
+        "--profile-startup",
+        default=False,
+        action="store_true",
+        help="Log how long importing modules, loading the model and answering the first request took. Run python with -X importtime for a per-module breakdown of the imports",
+    )
@@ -0,0 +1,101 @@
+import threading
+
+import backfill
+from backfill import BackfillPipeline
+from guess_requester import EndSlotUnkown
+
+GOOD_NODE = "http://good:5052"
+LAGGING_NODE = "http://lagging:5052"
+# Last slot the lagging node knows
+LAGGING_HEAD_SLOT = 3999
+
+
+class InsertedSlots:
+    # Stands in for ClickHouseDB, recording the inserted slots
+    def __init__(self):
+        self.slots = []
+        self.lock = threading.Lock()
+
+    def clone(self):
+        return self
+
+    def insert_client_guess_columns(self, columns):
+        with self.lock:
+            self.slots.extend(int(slot) for slot in columns["f_slot"])
+
+
+def download(start_slot, end_slot, node_url, beacon_client):
+    if beacon_client.nodes[0].url == LAGGING_NODE and end_slot > LAGGING_HEAD_SLOT:
+        raise EndSlotUnkown("End slot is unknown")
+    return [{"slot": slot} for slot in range(start_slot, end_slot + 1)]
+
+
+def guess(start_slot, end_slot, block_rewards, classifier, *args, **kwargs):
+    return [
+        (block_reward["slot"], "Lighthouse", "Lighthouse", {"Lighthouse": 1.0}, 0)
+        for block_reward in block_rewards
+    ]
+
+
+def test_lagging_node_doesnt_stop_the_backfill(monkeypatch):
+    monkeypatch.setattr(backfill, "downloadSlotBlockRewards", download)
+    monkeypatch.setattr(backfill, "buildSlotGuesses", guess)
+    db = InsertedSlots()
+    pipeline = BackfillPipeline(
+        None,
+        db,
+        node_url=f"{GOOD_NODE},{LAGGING_NODE}",
+        chunk_size=200,
+        download_workers=2,
+        queue_size=2,
+        beacon_client=object(),
+        store_features=False,
+    )
+
+    assert pipeline.run(0, 5999) == 5999
+    assert sorted(db.slots) == list(range(6000))
+
+
+def test_chunk_fails_once_every_node_failed_it(monkeypatch):
+    def unknown_end_slot(start_slot, end_slot, node_url, beacon_client):
+        if end_slot > LAGGING_HEAD_SLOT:
+            raise EndSlotUnkown("End slot is unknown")
+        return download(start_slot, end_slot, node_url, beacon_client)
+
+    monkeypatch.setattr(backfill, "downloadSlotBlockRewards", unknown_end_slot)
+    monkeypatch.setattr(backfill, "buildSlotGuesses", guess)
+    db = InsertedSlots()
+    pipeline = BackfillPipeline(
+        None,
+        db,
+        node_url=f"{GOOD_NODE},{LAGGING_NODE}",
+        chunk_size=200,
+        beacon_client=object(),
+        store_features=False,
+    )
+
+    assert pipeline.run(0, 5999) == LAGGING_HEAD_SLOT
+    assert sorted(db.slots) == list(range(LAGGING_HEAD_SLOT + 1))
+
+
+def test_refused_chunks_are_reported(monkeypatch):
+    def refuse_second_chunk(start_slot, end_slot, node_url, beacon_client):
+        if start_slot == 200:
+            return None
+        return download(start_slot, end_slot, node_url, beacon_client)
+
+    monkeypatch.setattr(backfill, "downloadSlotBlockRewards", refuse_second_chunk)
+    monkeypatch.setattr(backfill, "buildSlotGuesses", guess)
+    db = InsertedSlots()
+    pipeline = BackfillPipeline(
+        None,
+        db,
+        node_url=GOOD_NODE,
+        chunk_size=200,
+        beacon_client=object(),
+        store_features=False,
+    )
+
+    assert pipeline.run(0, 999) == 999
+    assert pipeline.skipped_ranges == [(200, 399)]
+    assert sorted(db.slots) == list(range(200)) + list(range(400, 1000))
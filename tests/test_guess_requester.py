@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+from guess_requester import classify_slot_features
+
+classifier = SimpleNamespace(
+    classifier=None,
+    features=["f0"],
+    enabled_clients=["Lighthouse", "Prysm"],
+    graffiti_only_clients={"Other"},
+)
+
+
+def test_graffiti_only_batch():
+    # No block goes through the model
+    slot_features = [(slot, slot * 3, "Other", {"f0": 0.5}) for slot in range(10)]
+
+    assert classify_slot_features(classifier, slot_features) == [
+        (
+            slot,
+            "Other",
+            "Other",
+            {"Lighthouse": 0.0, "Prysm": 0.0, "Other": 1.0},
+            slot * 3,
+        )
+        for slot in range(10)
+    ]
@@ -0,0 +1,86 @@
+import pickle
+
+import numpy as np
+import pytest
+
+blockprint_classifier = pytest.importorskip("blockprint.classifier")
+import blockprint.prepare_training_data as pt
+from sklearn.neighbors import KNeighborsClassifier
+
+from guess_requester import classify_block_rewards
+from snapshot import load_snapshot, save_snapshot
+
+FEATURES = ["f0", "f1", "f2"]
+ENABLED_CLIENTS = ["Lighthouse", "Prysm", "Teku"]
+GRAFFITI_ONLY_CLIENTS = ["Other"]
+
+
+def graffiti_client(block_reward):
+    graffiti = block_reward["meta"]["graffiti"]
+    return graffiti if graffiti in ENABLED_CLIENTS + GRAFFITI_ONLY_CLIENTS else None
+
+
+@pytest.fixture
+def block_rewards(monkeypatch):
+    # Blocks carry their feature row, so the test doesn't depend on how
+    # blockprint computes the features
+    def into_feature_row(block_reward, features):
+        return [block_reward["features"][name] for name in features]
+
+    for module in (blockprint_classifier, pt):
+        monkeypatch.setattr(module, "into_feature_row", into_feature_row, raising=False)
+        monkeypatch.setattr(
+            module, "classify_reward_by_graffiti", graffiti_client, raising=False
+        )
+    rng = np.random.default_rng(0)
+    graffitis = ["", "Lighthouse", "Other", "Other v1"]
+    return [
+        {
+            "meta": {"graffiti": graffitis[i % len(graffitis)]},
+            "features": dict(zip(FEATURES, rng.normal(size=len(FEATURES)).tolist())),
+        }
+        for i in range(200)
+    ]
+
+
+@pytest.fixture
+def classifier():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(300, len(FEATURES)))
+    y = (X[:, 0] > 0).astype(int) + (X[:, 1] > 0).astype(int)
+    model = KNeighborsClassifier(n_neighbors=5, weights="distance").fit(X, y)
+    # Built without a model folder to train from
+    classifier = blockprint_classifier.Classifier.__new__(
+        blockprint_classifier.Classifier
+    )
+    classifier.classifier = model
+    classifier.features = FEATURES
+    classifier.enabled_clients = ENABLED_CLIENTS
+    classifier.graffiti_only_clients = set(GRAFFITI_ONLY_CLIENTS)
+    return classifier
+
+
+def normalize(guesses):
+    return [
+        (label, multilabel, {client: float(p) for client, p in probs.items()}, graffiti)
+        for label, multilabel, probs, graffiti in guesses
+    ]
+
+
+def test_snapshot_matches_pickled_classifier(tmp_path, classifier, block_rewards):
+    pickled = pickle.loads(pickle.dumps(classifier))
+    save_snapshot(classifier, str(tmp_path / "snapshot"))
+    snapshot = load_snapshot(str(tmp_path / "snapshot"))
+
+    expected = normalize(
+        pickled.classify(block_reward) for block_reward in block_rewards
+    )
+    graffiti_only = [guess for guess in expected if guess[3] in GRAFFITI_ONLY_CLIENTS]
+    assert len(graffiti_only) > 0
+    assert all(guess[0] == "Other" for guess in graffiti_only)
+
+    assert (
+        normalize(snapshot.classify(block_reward) for block_reward in block_rewards)
+        == expected
+    )
+    assert normalize(classify_block_rewards(snapshot, block_rewards)) == expected